@@ -0,0 +1,395 @@
+""" Benchmark for 'TCP' over UDP: for every combination of a matrix of payload
+sizes, segment sizes, channel delays and drop probabilities, start a server,
+a channel and a client on ephemeral loopback ports (as threads of this
+process, or as driver.py subprocesses), transfer the payload and report
+goodput, chunk latency percentiles and retransmissions as JSON. Results can
+be compared against a stored baseline to flag regressions. Needs neither
+CouchDB nor Spark. Run from the src folder:
+
+    python bench.py --save_baseline baseline.json
+    python bench.py --baseline baseline.json -o results.json
+"""
+import argparse
+import csv
+import glob
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import statistics
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from lib.channel import Channel
+from lib.client import Client
+from lib.server import Server
+from lib.sink import MemorySink
+from lib.metrics import MetricsRegistry
+from lib.utils import TRANSFER_MODES, CONGESTION_CONTROL_NAMES
+
+DRIVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'driver.py')
+
+STANDARD_MATRIX = {
+    'payload_size': [16 * 1024, 256 * 1024],
+    'mss': [100, 1400],
+    'delay': [0.001, 0.01],
+    'drop': [0.0, 0.05],
+}
+# compared against the baseline; True if higher is better
+COMPARED_METRICS = {
+    'goodput': True,
+    'latency_p50': False,
+    'latency_p95': False,
+    'latency_p99': False,
+}
+
+
+class Bench:
+    def __init__(self, mode='thread', transfer_mode='sr', window_size=64, congestion='reno',
+        sleep_factor=2, timeout=1, run_timeout=300, seed=None, verbose=False):
+        """ mode: 'thread' runs the three components in this process,
+        'process' runs each as a driver.py subprocess; the other arguments
+        are those of the client and channel for every run """
+        self.setup_logging(verbose=verbose)
+        self.verbose = verbose
+        self.mode = mode
+        self.transfer_mode = transfer_mode
+        self.window_size = window_size
+        self.congestion = congestion
+        self.sleep_factor = sleep_factor
+        self.timeout = timeout
+        self.run_timeout = run_timeout # give up on a run after this many seconds
+        self.seed = seed
+
+    def setup_logging(self, verbose):
+        """ set up self.logger for producer logging """
+        self.logger = logging.getLogger('Bench')
+        formatter = logging.Formatter('%(prefix)s - %(message)s')
+        handler = logging.StreamHandler()
+        handler.setFormatter(formatter)
+        self.prefix = {'prefix': 'Bench'}
+        self.logger.addHandler(handler)
+        self.logger = logging.LoggerAdapter(self.logger, self.prefix)
+        if verbose:
+            self.logger.setLevel(logging.DEBUG)
+            self.logger.debug('Debug mode enabled', extra=self.prefix)
+        else:
+            self.logger.setLevel(logging.INFO)
+
+    def debug(self, msg):
+        self.logger.debug(msg, extra=self.prefix)
+
+    def info(self, msg):
+        self.logger.info(msg, extra=self.prefix)
+
+    def error(self, msg):
+        self.logger.error(msg, extra=self.prefix)
+
+    def config(self):
+        return {
+            'mode': self.mode,
+            'transfer_mode': self.transfer_mode,
+            'window_size': self.window_size,
+            'congestion': self.congestion,
+            'sleep_factor': self.sleep_factor,
+            'timeout': self.timeout,
+            'seed': self.seed,
+        }
+
+    def run_matrix(self, matrix, repeat=1):
+        """ Run every combination of the matrix, repeat times each; the
+        median of the repeats is reported """
+        results = []
+        keys = list(matrix)
+        for values in itertools.product(*(matrix[key] for key in keys)):
+            params = dict(zip(keys, values))
+            runs = [self.run(**params) for _ in range(repeat)]
+            results.append(combine_runs(params, runs))
+        return results
+
+    def run(self, payload_size, mss, delay, drop):
+        """ One transfer; return its measurements """
+        self.info(f'payload_size={payload_size} mss={mss} delay={delay} drop={drop}')
+        seed = self.seed if self.seed is not None else random.randrange(2 ** 32)
+        payload = make_payload(payload_size, seed)
+        if self.mode == 'process':
+            return self.run_subprocesses(payload, mss, delay, drop)
+        random.seed(seed) # the channel's drops and delays
+        return self.run_in_process(payload, mss, delay, drop)
+
+    def run_in_process(self, payload, mss, delay, drop):
+        sink = MemorySink()
+        server = Server(max_segment_size=mss, sink_factory=lambda addr: sink, verbose=self.verbose)
+        server.bind('127.0.0.1', 0)
+        channel = Channel(
+            verbose=self.verbose,
+            udp_port_channel=0,
+            udp_port_server=server.udp_port,
+            sleep_v=delay,
+            sleep_factor=self.sleep_factor,
+            p_drop_server=drop,
+            p_drop_client=drop)
+        threads = [threading.Thread(target=server.serve, daemon=True),
+                   threading.Thread(target=channel.run, daemon=True)]
+        for thread in threads:
+            thread.start()
+        metrics = MetricsRegistry()
+        client = Client(
+            channel_sleep_v=delay,
+            channel_sleep_factor=self.sleep_factor,
+            channel_p_drop_server=drop,
+            channel_p_drop_client=drop,
+            server_udp_port=channel.udp_port_channel,
+            max_segment_size=mss,
+            timeout=self.timeout,
+            transfer_mode=self.transfer_mode,
+            window_size=self.window_size,
+            congestion=self.congestion,
+            metrics=metrics,
+            verbose=self.verbose)
+        if not self.verbose:
+            # every loss is logged at INFO level; keep the report readable
+            for name in ('Server', 'Channel', 'Client'):
+                logging.getLogger(name).setLevel(logging.WARNING)
+        try:
+            client.start()
+            started = time.time()
+            times = client.send_reliable_message(payload)
+            duration = time.time() - started
+            if times is not None:
+                client.terminate()
+        finally:
+            server.stop()
+            channel.stop()
+            for thread in threads:
+                thread.join()
+        retransmits = sum(counter.value for counter in client.metric_retransmits.values())
+        return measurements(
+            len(payload), duration, [t['time_to_ack'] for t in times or []], retransmits,
+            ok=times is not None and bytes(sink.data) == payload)
+
+    def run_subprocesses(self, payload, mss, delay, drop):
+        with tempfile.TemporaryDirectory(prefix='bench-') as tmp:
+            payload_file = os.path.join(tmp, 'payload.txt')
+            received_file = os.path.join(tmp, 'received.txt')
+            metrics_file = os.path.join(tmp, 'client-metrics.json')
+            with open(payload_file, 'wb') as f:
+                f.write(payload)
+            port_server, port_channel = free_udp_port(), free_udp_port()
+            channel_args = [
+                '-sleepv', str(delay), '-sleepf', str(self.sleep_factor),
+                '-pds', str(drop), '-pdc', str(drop)]
+            output = None if self.verbose else subprocess.DEVNULL
+            components = [
+                subprocess.Popen([
+                    sys.executable, DRIVER, '--server', '-sport', str(port_server),
+                    '-mss', str(mss), '-o', received_file, *channel_args],
+                    stdout=output, stderr=output),
+                subprocess.Popen([
+                    sys.executable, DRIVER, '--channel', '-upc', str(port_channel),
+                    '-sport', str(port_server), *channel_args],
+                    stdout=output, stderr=output),
+            ]
+            try:
+                wait_for_ports([port_server, port_channel], self.run_timeout)
+                client = subprocess.run([
+                    sys.executable, DRIVER, '--client', '-sport', str(port_channel),
+                    '-mss', str(mss), '-f', payload_file, '-to', str(self.timeout),
+                    '-tm', self.transfer_mode, '-w', str(self.window_size), '-cc', self.congestion,
+                    # the client would wait out TIME_WAIT before exiting, and
+                    # nothing reuses its port
+                    '-msl', '0', '-d', os.path.join(tmp, 'data'), '-mfile', metrics_file,
+                    *channel_args],
+                    stdout=output, stderr=output, timeout=self.run_timeout)
+            finally:
+                for component in components:
+                    component.terminate()
+                for component in components:
+                    component.wait()
+            times = []
+            for path in glob.glob(os.path.join(tmp, 'data', '*.csv')):
+                with open(path, newline='') as f:
+                    times += [float(row['time_to_ack']) for row in csv.DictReader(f)]
+            with open(metrics_file) as f:
+                metrics = {
+                    (m['name'], tuple(sorted(m['labels'].items()))): m['value']
+                    for m in json.load(f)['metrics']}
+            retransmits = sum(value for (name, _), value in metrics.items()
+                              if name == 'tcpudp_client_retransmits_total')
+            goodput = metrics.get(('tcpudp_client_goodput_bytes_per_second', ()))
+            with open(received_file, 'rb') as f:
+                ok = client.returncode == 0 and f.read() == payload
+            return measurements(
+                len(payload), len(payload) / goodput if goodput else None, times, retransmits, ok)
+
+
+def make_payload(size, seed):
+    """ Printable bytes, so the client's chunk records stay valid CSV """
+    rng = random.Random(seed)
+    return ''.join(rng.choices(string.ascii_letters + string.digits, k=size)).encode()
+
+
+def measurements(payload_size, duration, times, retransmits, ok):
+    times = sorted(times)
+    return {
+        'ok': ok,
+        'duration': duration,
+        'goodput': payload_size / duration if duration else None,
+        'latency_p50': percentile(times, 0.5),
+        'latency_p95': percentile(times, 0.95),
+        'latency_p99': percentile(times, 0.99),
+        'retransmits': retransmits,
+        'chunks': len(times),
+    }
+
+
+def percentile(values, q):
+    """ Nearest rank percentile of sorted values """
+    if not values:
+        return None
+    return values[max(int(q * len(values) + 0.5) - 1, 0)]
+
+
+def combine_runs(params, runs):
+    """ The median of each measurement over repeated runs """
+    result = dict(params, ok=all(run['ok'] for run in runs), runs=len(runs))
+    for key in runs[0]:
+        if key == 'ok':
+            continue
+        values = [run[key] for run in runs if run[key] is not None]
+        result[key] = statistics.median(values) if values else None
+    return result
+
+
+def run_key(result):
+    return tuple(result[key] for key in STANDARD_MATRIX)
+
+
+def compare(results, baseline, tolerance):
+    """ Measurements worse than the baseline's by more than tolerance
+    (a fraction), and runs that failed where the baseline's did not """
+    baseline_runs = {run_key(run): run for run in baseline['results']}
+    regressions = []
+    for result in results:
+        before = baseline_runs.get(run_key(result))
+        if before is None:
+            continue
+        params = {key: result[key] for key in STANDARD_MATRIX}
+        if before['ok'] and not result['ok']:
+            regressions.append(dict(params, metric='ok', baseline=True, value=False))
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(dict(
+                    params, metric=metric, baseline=old, value=new, change=round(change, 3)))
+    return regressions
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_ports(ports, timeout):
+    """ Wait until subprocesses have bound the given UDP ports """
+    deadline = time.time() + timeout
+    for port in ports:
+        while True:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                try:
+                    sock.bind(('', port))
+                except OSError:
+                    break # taken, the component is up
+            if time.time() > deadline:
+                raise TimeoutError(f'nothing bound UDP port {port} within {timeout}s')
+            time.sleep(0.05)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('benchmark for TCP over UDP')
+    parser.add_argument('-mode', '--mode', choices=['thread', 'process'], default='thread', help=(
+        'run the server, channel and client as threads of the benchmark, or as driver.py '
+        'subprocesses (no shared interpreter, includes process startup)'
+    ))
+    parser.add_argument('-ps', '--payload_sizes', type=int, nargs='+',
+        default=STANDARD_MATRIX['payload_size'], help='bytes sent per run')
+    parser.add_argument('-mss', '--max_segment_sizes', type=int, nargs='+',
+        default=STANDARD_MATRIX['mss'], help='segment sizes')
+    parser.add_argument('-sleepv', '--delays', type=float, nargs='+',
+        default=STANDARD_MATRIX['delay'], help='channel sleep_v values (s)')
+    parser.add_argument('-pd', '--drops', type=float, nargs='+',
+        default=STANDARD_MATRIX['drop'], help=(
+            'drop probabilities, applied to both directions'
+        ))
+    parser.add_argument('-sleepf', '--channel_sleep_factor', type=float, default=2, help=(
+        'max delay as multiple of sleep_v'
+    ))
+    parser.add_argument('-tm', '--transfer_mode', choices=TRANSFER_MODES, default='sr')
+    parser.add_argument('-w', '--window_size', type=int, default=64)
+    parser.add_argument('-cc', '--congestion', choices=CONGESTION_CONTROL_NAMES, default='reno')
+    parser.add_argument('-to', '--timeout', type=float, default=1, help=(
+        'client socket timeout and initial retransmission timeout'
+    ))
+    parser.add_argument('-r', '--repeat', type=int, default=1, help=(
+        'runs per combination; the median is reported'
+    ))
+    parser.add_argument('-seed', '--seed', type=int, help=(
+        'seed for payloads and, with --mode thread, channel drops and delays'
+    ))
+    parser.add_argument('-rto', '--run_timeout', type=float, default=300, help=(
+        'give up on a run after this many seconds (--mode process)'
+    ))
+    parser.add_argument('-o', '--output', type=str, help='write the JSON report here instead of stdout')
+    parser.add_argument('-b', '--baseline', type=str, help=(
+        'JSON report of an earlier run; measurements worse by more than --tolerance are '
+        'reported as regressions and the exit status is 1'
+    ))
+    parser.add_argument('-tol', '--tolerance', type=float, default=0.2, help=(
+        'relative change from the baseline tolerated before flagging a regression'
+    ))
+    parser.add_argument('-sb', '--save_baseline', type=str, help='also save the report as a baseline here')
+    parser.add_argument('-v', '--verbose', action='store_true', help='use verbose logging')
+    args = parser.parse_args()
+
+    bench = Bench(
+        mode=args.mode,
+        transfer_mode=args.transfer_mode,
+        window_size=args.window_size,
+        congestion=args.congestion,
+        sleep_factor=args.channel_sleep_factor,
+        timeout=args.timeout,
+        run_timeout=args.run_timeout,
+        seed=args.seed,
+        verbose=args.verbose)
+    results = bench.run_matrix({
+        'payload_size': args.payload_sizes,
+        'mss': args.max_segment_sizes,
+        'delay': args.delays,
+        'drop': args.drops,
+    }, repeat=args.repeat)
+    report = {'config': bench.config(), 'results': results}
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare(results, json.load(f), args.tolerance)
+        for regression in report['regressions']:
+            bench.error(f'regression: {regression}')
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            f.write(text + '\n')
+    sys.exit(1 if report.get('regressions') else 0)
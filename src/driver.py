@@ -1,18 +1,26 @@
-""" Driver for 'TCP' over UDP assignment; use driver to create either a server, a client or a channel """
+""" Driver for 'TCP' over UDP assignment; use driver to create either a server, a client or a channel.
+Only the modules of the selected role are imported (see run), so short-lived
+channel, server and client processes start quickly and do not need the
+aggregator's dependencies installed """
+import sys
+if '--startup_profile' in sys.argv or '--startup-profile' in sys.argv:
+    # installed before anything else is imported, so that every import is timed
+    from lib.startup import ImportProfiler
+    import_profiler = ImportProfiler().start()
+else:
+    import_profiler = None
 import argparse
 import logging
-from pathlib import Path
-import sys
-from urllib import parse
-from lib.channel import Channel
-from lib.server import Server
-from lib.client import Client
-from lib.aggregator import Aggregator
+import os
+import signal
+from lib.utils import (
+    HEADER_FORMATS, MAX_MSS, MAX_MSS_FIELD, TRANSFER_MODES, CONGESTION_CONTROL_NAMES, ENGINES, set_header_format)
 
 
 class Driver:
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, import_profiler=None):
         self.setup_logging(verbose=verbose)
+        self.import_profiler = import_profiler
 
     def setup_logging(self, verbose):
         """ set up self.logger for producer logging """
@@ -38,6 +46,163 @@ class Driver:
     def error(self, msg):
         self.logger.error(msg, extra=self.prefix)
 
+    def startup_complete(self):
+        """ Report import times (--startup_profile) once the selected role
+        has imported its modules """
+        if self.import_profiler is not None:
+            self.import_profiler.stop()
+            self.info(f'Import times (ms), slowest first:\n{self.import_profiler.report()}')
+
+
+def run(args, driver, trace=None, metrics=None):
+    """ Run the channel, server, client or aggregator selected by args,
+    importing only what that role uses """
+    if args.asyncio:
+        import asyncio
+    if args.aggregator:
+        from lib.aggregator import Aggregator
+        driver.startup_complete()
+        aggregator = Aggregator(
+            verbose=args.verbose, page_size=args.page_size, engine=args.engine)
+        if args.incremental:
+            aggregator.run_incremental()
+        else:
+            # You need to manually create a database called "complete" in your
+            # couchbase server in order to trigger the aggregator
+            aggregator.run()
+
+    elif args.channel:
+        if args.asyncio:
+            from lib.aio import AsyncChannel as Channel
+        else:
+            from lib.channel import Channel
+        driver.startup_complete()
+        channel = Channel(
+            verbose=args.verbose,
+            udp_ip=args.server_udp_ip,
+            udp_port_channel=args.udp_port_channel,
+            udp_port_server=args.server_udp_port,
+            sleep_v=args.channel_sleep_v,
+            sleep_factor=args.channel_sleep_factor,
+            p_drop_server=args.p_drop_server,
+            p_drop_client=args.p_drop_client,
+            flow_idle_timeout=args.flow_idle_timeout,
+            batch_io=not args.no_batch_io,
+            trace=trace,
+            metrics=metrics
+            )
+        if args.asyncio:
+            asyncio.run(channel.run())
+        else:
+            channel.run()
+
+    elif args.server:
+        if args.asyncio:
+            from lib.aio import AsyncServer as Server
+        else:
+            from lib.server import Server
+        driver.startup_complete()
+        server = Server(
+            window_size=args.window_size or 64,
+            max_segment_size=args.max_segment_size or (MAX_MSS_FIELD if args.header_format == 'legacy' else 1400),
+            ack_every=args.ack_every,
+            ack_delay=args.ack_delay,
+            max_segment_lifetime=args.max_segment_lifetime,
+            output_file=args.output_file,
+            segment_files=args.segment_files,
+            fsync=args.fsync,
+            preallocate=args.preallocate,
+            batch_io=not args.no_batch_io,
+            trace=trace,
+            metrics=metrics,
+            verbose=args.verbose
+            )
+        started = server.start(
+            udp_ip=args.server_udp_ip,
+            udp_port=args.server_udp_port,
+        )
+        if args.asyncio:
+            asyncio.run(started)
+
+    elif args.client:
+        if not args.msg_string and not args.msg_file:
+            raise argparse.ArgumentError(
+                'You need to provide either a -f MSG_FILE or -m "MSG STRING" argument '
+                'with -cli so that the client has a message to send'
+            )
+        elif args.msg_file and not os.path.isfile(args.msg_file):
+            driver.error(f'{args.msg_file} is not a file')
+            sys.exit(1)
+        if args.asyncio:
+            from lib.aio import AsyncClient as Client
+        else:
+            from lib.client import Client
+        telemetry = None
+        if args.dump_couchdb:
+            from lib.telemetry import TelemetryExporter
+            telemetry = TelemetryExporter.from_environment(
+                spool_path=args.couchdb_spool, verbose=args.verbose).start()
+        driver.startup_complete()
+        client = Client(
+            channel_sleep_v=args.channel_sleep_v,
+            channel_sleep_factor=args.channel_sleep_factor,
+            channel_p_drop_server=args.p_drop_server,
+            channel_p_drop_client=args.p_drop_client,
+            server_udp_ip=args.server_udp_ip,
+            server_udp_port=args.server_udp_port,
+            max_segment_size=args.max_segment_size or (MAX_MSS if args.probe_mtu else 12),
+            probe_mtu=args.probe_mtu,
+            timeout=args.timeout,
+            min_rto=args.min_rto,
+            max_rto=args.max_rto,
+            max_retransmits=args.max_retransmits,
+            max_segment_lifetime=args.max_segment_lifetime,
+            transfer_mode=args.transfer_mode,
+            window_size=args.window_size or (1 if args.congestion == 'none' else 64),
+            congestion=args.congestion,
+            batch_io=not args.no_batch_io,
+            trace=trace,
+            metrics=metrics,
+            telemetry=telemetry,
+            verbose=args.verbose
+        )
+        # the file is streamed, not read up front; a record per chunk is only
+        # kept if it is going to be dumped to a folder (couchdb gets them
+        # from the telemetry exporter as the transfer goes)
+        record_chunks = bool(args.dump_folder or args.results_store)
+        def send():
+            if args.msg_string:
+                return client.send_reliable_message(args.msg_string, record_chunks)
+            return client.send_file(args.msg_file, record_chunks)
+        def save(data):
+            if args.dump_folder:
+                os.makedirs(args.dump_folder, exist_ok=True)
+                client.dump_data_to_folder(args.dump_folder, data)
+            if args.results_store:
+                client.dump_data_to_store(args.results_store, data)
+        # the records are saved while the client is in TIME_WAIT, which has
+        # to be over before the process exits: exiting would close the socket
+        # and leave a repeated FINACK unacknowledged
+        try:
+            if args.asyncio:
+                async def transfer():
+                    await client.start()
+                    data = await send()
+                    await client.terminate()
+                    save(data)
+                    await client.wait_closed()
+                asyncio.run(transfer())
+            else:
+                client.start()
+                data = send()
+                client.terminate()
+                save(data)
+                client.wait_closed()
+        finally:
+            if telemetry is not None:
+                telemetry.stop()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser('driver for TCP over UDP simulation')
     ### CHANNEL OPTS ###
@@ -46,6 +211,11 @@ if __name__ == "__main__":
     ))
     parser.add_argument('-upc','--udp_port_channel', type=int, default=5007,
         help='port for binding socket for client <-> channel communication')
+    parser.add_argument('-idle', '--flow_idle_timeout', type=float, default=60,
+        help=(
+            'the channel relays any number of clients, each over its own upstream '
+            'socket; a client silent for this many seconds is forgotten'
+        ))
 
     ### END CHANNEL OPTS ####
 
@@ -79,6 +249,22 @@ if __name__ == "__main__":
             'probability of channel dropping a message from client to server; '
             'required for all components for data/stats logging purposes')
     )
+    parser.add_argument('-tm', '--transfer_mode', choices=TRANSFER_MODES, default='gbn', help=(
+        'sliding window protocol used by the client: Go-Back-N, or Selective Repeat '
+        'which only resends segments the server has not reported (SACK) holding')
+    )
+    parser.add_argument('-w', '--window_size', type=int, default=None, help=(
+        'max number of unacknowledged segments in flight (client, default 1 which gives '
+        'stop-and-wait) / out of order segments held for reassembly (server, default 64)')
+    )
+    parser.add_argument('-hf', '--header_format', choices=HEADER_FORMATS, default='binary',
+        help=(
+            'wire format for headers sent by this component; "binary" is the packed 12 byte '
+            'header, "legacy" the 96 byte ASCII bit string; received headers of either '
+            'format are always understood. The legacy header has no options, so its SYN and '
+            'SYN-ACK only carry an MSS of up to 15: it needs -mss 15 or less and no --probe_mtu, '
+            'and a legacy server defaults to -mss 15')
+    )
     ### END REQUIRED FOR ALL ####
 
     ### CLIENT OPTS ####
@@ -91,11 +277,44 @@ if __name__ == "__main__":
     parser.add_argument('-sport', '--server_udp_port', default=5008, type=int, help=(
         'UDP Server port'
     ))
-    parser.add_argument('-mss', '--max_segment_size', default=12, type=int, help=(
-        'max number of bytes client can receive or send in single segment'
+    parser.add_argument('-mss', '--max_segment_size', default=None, type=int, help=(
+        'max number of bytes client can receive or send in single segment (default 12) / '
+        'server accepts in a single segment (default 1400); negotiated in the handshake, '
+        'up to 65535'
+    ))
+    parser.add_argument('-pmtu', '--probe_mtu', action='store_true', help=(
+        'client also keeps segments within the path MTU to the server (Linux); without '
+        '-mss, uses the largest segment the path allows'
+    ))
+    parser.add_argument('-to', '--timeout', default=1, type=float, help=(
+        'socket timeout for handshake/teardown, and the initial retransmission timeout '
+        'used until RTT samples are available'
+    ))
+    parser.add_argument('-minrto', '--min_rto', default=0.2, type=float, help=(
+        'lower bound (s) for the RTT-based retransmission timeout'
+    ))
+    parser.add_argument('-maxrto', '--max_rto', default=10.0, type=float, help=(
+        'upper bound (s) for the retransmission timeout after exponential backoff'
+    ))
+    parser.add_argument('-acke', '--ack_every', default=1, type=int, help=(
+        'server acknowledges every Nth in order segment (delayed, cumulative ACKs); out of '
+        'order segments are still acknowledged at once'
     ))
-    parser.add_argument('-to', '--timeout', default=1, type=int, help=(
-        'socket timeout'
+    parser.add_argument('-ackd', '--ack_delay', default=0.04, type=float, help=(
+        'with --ack_every > 1, max seconds the server waits before acknowledging a segment'
+    ))
+    parser.add_argument('-msl', '--max_segment_lifetime', default=5, type=float, help=(
+        'max segment lifetime (s); after a connection is closed, the client and the server '
+        'absorb its late segments for twice this; the server serves other clients meanwhile, '
+        'the client saves its records and then waits for the rest of this time before exiting'
+    ))
+    parser.add_argument('-maxrt', '--max_retransmits', default=30, type=int, help=(
+        'number of times a segment is resent without an ACK before giving up on the server'
+    ))
+    parser.add_argument('-cc', '--congestion', choices=CONGESTION_CONTROL_NAMES, default='none', help=(
+        'congestion control used by the client: the congestion window it keeps limits the '
+        'bytes in flight within --window_size (which then defaults to 64); cwnd and ssthresh '
+        'are recorded with every acknowledged chunk'
     ))
     ### ONE OF THESE TWO REQUIRED FOR -cli ####
     parser.add_argument('-f', '--msg_file', type=str, help=(
@@ -109,9 +328,18 @@ if __name__ == "__main__":
         'should be written by the client'
     ))
 
+    parser.add_argument('-rs', '--results_store', type=str, help=(
+        'folder of a columnar results store the client appends its time data to as a run; '
+        'query it with python -m lib.results'
+    ))
     parser.add_argument('-cdb', '--dump_couchdb', action='store_true', help=(
         'dump time data to couchdb; this depends on COUCHDB_* environment variables '
-        'COUCHDB_USER, COUCHDB_SERVER, COUCHDB_PASSWORD, COUCHDB_DATABASE; only works with --client'
+        'COUCHDB_USER, COUCHDB_SERVER, COUCHDB_PASSWORD, COUCHDB_DATABASE; only works with --client. '
+        'Records are posted in batches while the transfer runs'
+    ))
+    parser.add_argument('-spool', '--couchdb_spool', default='couchdb-spool.jsonl', type=str, help=(
+        'with --dump_couchdb, file the records are appended to while couchdb cannot be reached; '
+        'they are saved from it by the next client that reaches the database'
     ))
     ### END CLIENT OPTS ###
 
@@ -119,85 +347,114 @@ if __name__ == "__main__":
     parser.add_argument('-srv', '--server', action='store_true', help=(
         'create a "TCP" over UDP server'
     ))
+    parser.add_argument('-o', '--output_file', default='./server/received-full-msg-{host}_{port}.txt', type=str, help=(
+        'file the server streams each received message to; {host} and {port} are '
+        'replaced with the address of the client, so concurrent clients get their own file'
+    ))
+    parser.add_argument('-segf', '--segment_files', action='store_true', help=(
+        'debugging aid for the server: also write every received segment to its own '
+        'received-seqnum-<seq_num>.txt file next to --output_file'
+    ))
+    parser.add_argument('-fsync', '--fsync', action='store_true', help=(
+        'fsync the server output file on every batched flush'
+    ))
+    parser.add_argument('-prealloc', '--preallocate', default=0, type=int, help=(
+        'number of bytes to preallocate for the server output file'
+    ))
     ### END SERVER OPTS ###
     parser.add_argument('-v', '--verbose', action='store_true', help=(
         'use verbose logging'
     ))
+    parser.add_argument('-aio', '--asyncio', action='store_true', help=(
+        'run the channel, server or client on an asyncio event loop instead of '
+        'blocking sockets and threads'
+    ))
+    parser.add_argument('-sprof', '--startup_profile', '--startup-profile', action='store_true', help=(
+        'report the time taken to import each module once the selected role is ready to run'
+    ))
+    parser.add_argument('-nobatch', '--no_batch_io', action='store_true', help=(
+        'send and receive one datagram per system call; by default the blocking channel, '
+        'server and client move many per call with sendmmsg/recvmmsg where available (Linux)'
+    ))
+    parser.add_argument('-trace', '--trace', type=str, help=(
+        'record every segment the channel, server or client sends, receives, drops or '
+        'resends in a binary ring buffer, dumped to this file on exit (also on SIGTERM); '
+        'decode it afterwards with: python -m lib.trace FILE [FILE ...]'
+    ))
+    parser.add_argument('-tsize', '--trace_size', type=int, default=65536, help=(
+        'number of packet events the trace keeps; older events are overwritten'
+    ))
+    parser.add_argument('-mport', '--metrics_port', type=int, help=(
+        'serve live metrics (RTT and chunk latency histograms, retransmits, duplicates, '
+        'bytes in flight, goodput, drops) at http://127.0.0.1:PORT/metrics in the '
+        'Prometheus text format, and as JSON at /snapshot'
+    ))
+    parser.add_argument('-mfile', '--metrics_file', type=str, help=(
+        'write a JSON snapshot of the live metrics to this file every --metrics_interval '
+        'seconds, and on exit'
+    ))
+    parser.add_argument('-mint', '--metrics_interval', type=float, default=5.0, help=(
+        'seconds between snapshots written to --metrics_file'
+    ))
 
 
     ### Aggregator opts ####
     parser.add_argument('-agg', '--aggregator', action='store_true', help=(
         'run an aggregator (reads from couchdb database using COUCHDB_* environment variables '
         'to calculate average time_to_ack for each combination of channel properties '
-        '(sleepv, sleepfactor, pdropserver, pdropclient) using MapReduce'
+        '(sleepv, sleepfactor, pdropserver, pdropclient)'
+    ))
+    parser.add_argument('-inc', '--incremental', action='store_true', help=(
+        'with --aggregator, instead of waiting for the "complete" database, keep count, '
+        'mean and variance of time_to_ack per combination up to date in aggregated_analytics '
+        'by following the changes feed of the database, from where it last stopped'
+    ))
+    parser.add_argument('-engine', '--engine', choices=ENGINES, default='numpy', help=(
+        'with --aggregator: numpy computes count, mean, stddev, p50/p90/p99 and max in process; '
+        'spark computes the mean with Spark MapReduce (needs pyspark); view computes count, '
+        'mean, stddev and max with a map/reduce (_stats) view inside CouchDB'
+    ))
+    parser.add_argument('-page', '--page_size', type=int, default=1000, help=(
+        'with --aggregator, documents read or written per CouchDB bulk request'
     ))
     ### End Aggregator opts ####
 
 
     args = parser.parse_args()
+    if args.header_format == 'legacy' and (
+            args.probe_mtu or (args.max_segment_size or 0) > MAX_MSS_FIELD):
+        # the peer would silently negotiate the MSS down to what 4 bits hold
+        parser.error(
+            f'--header_format legacy only carries an MSS of up to {MAX_MSS_FIELD}; '
+            f'use -mss {MAX_MSS_FIELD} or less, without --probe_mtu')
 
 
-    driver = Driver(verbose=args.verbose)
-    if args.aggregator:
-        aggregator = Aggregator(verbose=args.verbose)
-        # You need to manually create a database called "complete" in your
-        # couchbase server in order to trigger the aggregator
-        aggregator.run()
-
-    elif args.channel:
-        channel = Channel(
-            verbose=args.verbose,
-            udp_ip=args.server_udp_ip,
-            udp_port_channel=args.udp_port_channel,
-            udp_port_server=args.server_udp_port,
-            sleep_v=args.channel_sleep_v,
-            sleep_factor=args.channel_sleep_factor,
-            p_drop_server=args.p_drop_server,
-            p_drop_client=args.p_drop_client
-            )
-        channel.run()
-
-    elif args.server:
-        server = Server(verbose=args.verbose)
-        server.start(
-            udp_ip=args.server_udp_ip,
-            udp_port=args.server_udp_port,
-        )
-
-    elif args.client:
-        if not args.msg_string and not args.msg_file:
-            raise argparse.ArgumentError(
-                'You need to provide either a -f MSG_FILE or -m "MSG STRING" argument '
-                'with -cli so that the client has a message to send'
-            )
-        elif args.msg_string:
-            msg = args.msg_string
-        elif args.msg_file:
-            try:
-                f = open(args.msg_file, 'r')
-                msg = f.read()
-                f.close()
-            except Exception as e:
-                driver.error(e)
-                sys.exit(1)
-        client = Client(
-            channel_sleep_v=args.channel_sleep_v,
-            channel_sleep_factor=args.channel_sleep_factor,
-            channel_p_drop_server=args.p_drop_server,
-            channel_p_drop_client=args.p_drop_client,
-            server_udp_ip=args.server_udp_ip,
-            server_udp_port=args.server_udp_port,
-            max_segment_size=args.max_segment_size,
-            timeout=args.timeout,
-            verbose=args.verbose
-        )
-        client.start()
-        data = client.send_reliable_message(msg)
-        client.terminate()
-        if args.dump_folder:
-            Path(args.dump_folder).mkdir(parents=True, exist_ok=True)
-            client.dump_data_to_folder(args.dump_folder, data)
-        if args.dump_couchdb:
-            client.dump_data_to_couchdb(data)
-
-
+    driver = Driver(verbose=args.verbose, import_profiler=import_profiler)
+    set_header_format(args.header_format)
+    trace = None
+    if args.trace:
+        from lib.trace import PacketTrace
+        trace = PacketTrace(capacity=args.trace_size)
+    metrics, exporter = None, None
+    if args.metrics_port is not None or args.metrics_file:
+        from lib.metrics import MetricsRegistry, MetricsExporter
+        metrics = MetricsRegistry()
+        exporter = MetricsExporter(
+            metrics, port=args.metrics_port, path=args.metrics_file,
+            interval=args.metrics_interval).start()
+        if args.metrics_port is not None:
+            driver.info(f'Serving metrics at http://127.0.0.1:{exporter.port}/metrics')
+    if trace is not None or exporter is not None:
+        # servers and channels run until killed; let the trace and the
+        # final metrics be written then
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        run(args, driver, trace, metrics)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if exporter is not None:
+            exporter.stop()
+        if trace is not None:
+            trace.dump(args.trace)
+            driver.info(f'Wrote {len(trace)} of {trace.count} packet events to {args.trace}')
@@ -1,13 +1,54 @@
 from .utils import *
 import logging
-import couchdb
+import math
 import time
-from pyspark.sql import SparkSession, Row
+
+# ids of the documents run_incremental() keeps in aggregated_analytics
+GROUP_ID_PREFIX = 'stats-'
+CHECKPOINT_ID = '_local/aggregator-checkpoint'
+# design document grouping time_to_ack by channel parameters inside CouchDB
+DESIGN_ID = '_design/aggregator'
+STATS_VIEW = 'time_to_ack_by_channel'
+STATS_VIEW_MAP = (
+    'function (doc) {'
+    ' if (doc.time_to_ack !== undefined && doc.time_to_ack !== null) {'
+    ' emit([doc.channel_p_drop_server, doc.channel_p_drop_client,'
+    ' doc.channel_sleep_v, doc.channel_sleep_factor], doc.time_to_ack); } }'
+)
+
+
+class RunningStats:
+    """ Count, sum, mean and variance of a stream of values, updated one
+    value at a time (Welford's algorithm) so they never need recomputing """
+    def __init__(self, count=0, total=0.0, mean=0.0, m2=0.0):
+        self.count = count
+        self.total = total
+        self.mean = mean
+        self.m2 = m2 # sum of squared differences from the mean
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        """ Sample variance; 0 until there are two values """
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance)
 
 
 class Aggregator:
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, page_size=1000, engine='numpy'):
         self.setup_logging(verbose=verbose)
+        # documents per _all_docs / _bulk_docs request
+        self.page_size = page_size
+        self.engine = engine # one of ENGINES
         # Use environment for couchdb connection
         self.couchdb_server = os.environ.get('COUCHDB_SERVER', 'localhost:5984')
         self.couchdb_user = os.environ.get('COUCHDB_USER', 'admin')
@@ -23,6 +64,9 @@ class Aggregator:
 
 
     def connect_couchdb(self):
+        # imported here so that the driver can list the aggregator options
+        # without couchdb installed
+        import couchdb
         # couchdb connection
         self.debug(
             f'Connecting to CouchDB server at: http://{self.couchdb_user}:{self.couchdb_password}@{self.couchdb_server}/"')
@@ -48,7 +92,8 @@ class Aggregator:
         handler = logging.StreamHandler()
         handler.setFormatter(formatter)
         self.prefix = {'prefix': 'Aggregator'}
-        self.logger.addHandler(handler)
+        if not self.logger.handlers:
+            self.logger.addHandler(handler)
         self.logger = logging.LoggerAdapter(self.logger, self.prefix)
         if verbose:
             self.logger.setLevel(logging.DEBUG)
@@ -65,9 +110,69 @@ class Aggregator:
     def error(self, msg):
         self.logger.error(msg, extra=self.prefix)
 
+    def iter_docs(self, db):
+        """ All documents of db (except design documents), read
+        page_size at a time with _all_docs?include_docs=true """
+        for row in db.iterview('_all_docs', self.page_size, include_docs=True):
+            if not row.id.startswith('_design/'):
+                yield row.doc
+
+    def ensure_stats_view(self, db):
+        """ Create or update the design document of the _stats view """
+        views = {STATS_VIEW: {'map': STATS_VIEW_MAP, 'reduce': '_stats'}}
+        design = db.get(DESIGN_ID) or {'_id': DESIGN_ID}
+        if design.get('views') != views:
+            design['language'] = 'javascript'
+            design['views'] = views
+            db.save(design)
+            self.debug(f'Saved view {DESIGN_ID}/_view/{STATS_VIEW}')
+
+    def aggregate_numpy(self, db):
+        """ count, mean, stddev, percentiles and max of time_to_ack per
+        group, computed in process from columns of the documents """
+        # optional: only the numpy engine (the default) needs numpy installed
+        from .grouping import PERCENTILES, to_columns, group_stats
+        keys, values = to_columns((
+            (key, doc['time_to_ack']) for doc in self.iter_docs(db)
+            if (key := self.group_key(doc)) is not None
+        ), len(GROUP_FIELDS))
+        keys, stats = group_stats(keys, values)
+        self.debug(f'Grouped {len(values)} records into {len(keys)} groups')
+        results = []
+        for i, key in enumerate(keys.tolist()):
+            result = {
+                'count': int(stats['count'][i]),
+                'avg_time_to_ack': float(stats['mean'][i]),
+                'stddev_time_to_ack': float(stats['stddev'][i]),
+                'max_time_to_ack': float(stats['max'][i]),
+            }
+            result.update((f'p{p}_time_to_ack', float(stats[f'p{p}'][i])) for p in PERCENTILES)
+            results.append((tuple(key), result))
+        return results
+
+    def aggregate_view(self, db):
+        """ count, mean, stddev and max of time_to_ack per group, with the
+        grouping done inside CouchDB by the built-in _stats reduce of a view
+        keyed by the channel parameters; only one row per group leaves the
+        database. _stats has no percentiles """
+        self.ensure_stats_view(db)
+        results = []
+        for row in db.view(f'{DESIGN_ID[len("_design/"):]}/{STATS_VIEW}', group=True):
+            count, total = row.value['count'], row.value['sum']
+            variance = (row.value['sumsqr'] - total * total / count) / (count - 1) if count > 1 else 0.0
+            results.append((tuple(row.key), {
+                'count': count,
+                'avg_time_to_ack': total / count,
+                'stddev_time_to_ack': math.sqrt(max(variance, 0.0)),
+                'max_time_to_ack': row.value['max'],
+            }))
+        return results
+
     def aggregate(self):
-        """ Aggregate/get averages for response times stored in analytics DB by client
-        (ack times with varying drop probabilities)"""
+        """ Aggregate response times stored in analytics DB by client (ack
+        times with varying drop probabilities) per combination of channel
+        properties; return (key, statistics) pairs, the statistics including
+        at least avg_time_to_ack """
 
         try:
             db = self.couch.create(self.couchdb_database)
@@ -78,16 +183,26 @@ class Aggregator:
             self.debug(
                 f"Successfully connected to existing CouchDB database {self.couchdb_database}")
 
+        if self.engine == 'view':
+            return self.aggregate_view(db)
+        if self.engine == 'spark':
+            return self.aggregate_spark(db)
+        return self.aggregate_numpy(db)
+
+    def aggregate_spark(self, db):
+        """ Average time_to_ack per group with Spark MapReduce """
+        # optional: only the spark engine needs pyspark installed
+        from pyspark.sql import SparkSession, Row
         mapped = SparkSession.builder.appName("aggregatedTimeAnalysis")\
                 .getOrCreate()\
                 .createDataFrame(
                     Row(
-                        time_to_ack=db.get(doc_id).get('time_to_ack'),
-                        channel_sleep_v=db.get(doc_id).get('channel_sleep_v'),
-                        channel_sleep_factor=db.get(doc_id).get('channel_sleep_factor'),
-                        channel_p_drop_server=db.get(doc_id).get('channel_p_drop_server'),
-                        channel_p_drop_client=db.get(doc_id).get('channel_p_drop_client'),
-                    ) for doc_id in db
+                        time_to_ack=doc.get('time_to_ack'),
+                        channel_sleep_v=doc.get('channel_sleep_v'),
+                        channel_sleep_factor=doc.get('channel_sleep_factor'),
+                        channel_p_drop_server=doc.get('channel_p_drop_server'),
+                        channel_p_drop_client=doc.get('channel_p_drop_client'),
+                    ) for doc in self.iter_docs(db)
                 )\
                 .rdd.map(
                     lambda row: (
@@ -110,7 +225,7 @@ class Aggregator:
         seqFunc=lambda a, b: (a[0] + b,    a[1] + 1),
         combFunc=lambda a, b: (a[0] + b[0], a[1] + b[1]))\
         .mapValues(lambda v: v[0]/v[1]).collect()  # divide sum by count
-        return reduced
+        return [(key, {'avg_time_to_ack': avg}) for key, avg in reduced]
 
     def save_lst_to_db(self, lst, db_name="aggregated_analytics"):
         """ save each record in a list to a database (specified with db name) """
@@ -121,25 +236,118 @@ class Aggregator:
             db = self.couch[db_name]
             self.debug(f"Successfully connected to existing CouchDB database {db_name}")
         self.debug(f'Preparing to save {len(lst)} items to database')
+        jsonified = [{
+            'channel_sleep_v': msg[0][2],
+            'channel_sleep_factor': msg[0][3],
+            'channel_p_drop_server': msg[0][0],
+            'channel_p_drop_client': msg[0][1],
+            **msg[1]
+        } for msg in lst]
         fails = 0
-        for msg in lst:
+        for start in range(0, len(jsonified), self.page_size):
+            page = jsonified[start:start + self.page_size]
             try:
-                jsonified_msg = {
-                    'channel_sleep_v': msg[0][2],
-                    'channel_sleep_factor': msg[0][3],
-                    'channel_p_drop_server': msg[0][0],
-                    'channel_p_drop_client': msg[0][1],
-                    'avg_time_to_ack': msg[1]
-                }
-                db.save(jsonified_msg)
+                for success, doc_id, result in db.update(page):
+                    if not success:
+                        self.error(f'Failed to save {doc_id}: {result}')
+                        fails += 1
             except Exception as e:
                 self.error(e)
-                fails += 1
+                fails += len(page)
         self.debug("Saving completed")
         self.debug(f"Failed to send {fails} items")
 
+    def group_key(self, doc):
+        """ Channel parameters of an analytics document, or None if it is
+        not a time_to_ack record """
+        if doc.get('time_to_ack') is None or any(field not in doc for field in GROUP_FIELDS):
+            return None
+        return tuple(doc[field] for field in GROUP_FIELDS)
+
+    def group_id(self, key):
+        return GROUP_ID_PREFIX + '-'.join(str(value) for value in key)
+
+    def load_groups(self, db):
+        """ Running statistics saved by run_incremental(), by group key,
+        each with the document it is saved in """
+        groups = {}
+        for row in db.view('_all_docs', include_docs=True,
+                startkey=GROUP_ID_PREFIX, endkey=GROUP_ID_PREFIX + '\ufff0'):
+            doc = row.doc
+            stats = RunningStats(
+                doc['count'], doc['sum_time_to_ack'], doc['avg_time_to_ack'], doc['m2_time_to_ack'])
+            groups[tuple(doc[field] for field in GROUP_FIELDS)] = (stats, doc)
+        return groups
+
+    def apply_changes(self, groups, changes):
+        """ Add the time_to_ack of every new analytics document to the
+        statistics of its group; return the keys of the groups changed.
+        Clients only ever add records, so documents are not expected to be
+        updated; deletions are ignored """
+        changed = set()
+        for change in changes:
+            doc = change.get('doc')
+            if change.get('deleted') or doc is None or change['id'].startswith('_design/'):
+                continue
+            key = self.group_key(doc)
+            if key is None:
+                continue
+            if key not in groups:
+                groups[key] = (RunningStats(), {'_id': self.group_id(key)})
+            groups[key][0].add(doc['time_to_ack'])
+            changed.add(key)
+        return changed
 
+    def save_groups(self, db, groups, keys):
+        """ Upsert the documents of the given groups in one request """
+        docs = []
+        for key in keys:
+            stats, doc = groups[key]
+            doc.update(zip(GROUP_FIELDS, key))
+            doc.update({
+                'count': stats.count,
+                'sum_time_to_ack': stats.total,
+                'avg_time_to_ack': stats.mean,
+                'var_time_to_ack': stats.variance,
+                'stddev_time_to_ack': stats.stddev,
+                'm2_time_to_ack': stats.m2,
+            })
+            docs.append(doc)
+        # the documents get their new _rev, ready for the next upsert
+        for success, doc_id, result in db.update(docs):
+            if not success:
+                self.error(f'Failed to save {doc_id}: {result}')
 
+    def run_incremental(self, db_name='aggregated_analytics', batch_size=1000, poll_timeout=60):
+        """ Keep the count, mean and variance of time_to_ack per group of
+        channel parameters up to date in db_name by following the _changes
+        feed of the analytics database: each record is read once, when it
+        arrives, and only the groups it changes are rewritten. The last
+        sequence processed is checkpointed (as a _local document of
+        db_name) so a restart resumes where it stopped; a crash between
+        saving the groups and the checkpoint counts that batch twice.
+        Runs until interrupted """
+        try:
+            out = self.couch.create(db_name)
+            self.debug(f"Successfully created new CouchDB database {db_name}")
+        except:
+            out = self.couch[db_name]
+            self.debug(f"Successfully connected to existing CouchDB database {db_name}")
+        checkpoint = out.get(CHECKPOINT_ID) or {'_id': CHECKPOINT_ID, 'since': 0}
+        groups = self.load_groups(out)
+        self.info(f'Following changes of {self.couchdb_database} since {checkpoint["since"]}, '
+            f'{len(groups)} groups so far')
+        while True:
+            changes = self.db.changes(
+                feed='longpoll', since=checkpoint['since'], include_docs=True,
+                limit=batch_size, timeout=int(poll_timeout * 1000))
+            changed = self.apply_changes(groups, changes['results'])
+            if changed:
+                self.save_groups(out, groups, changed)
+                self.info(f'{len(changes["results"])} changes, updated {len(changed)} groups')
+            if changes['last_seq'] != checkpoint['since']:
+                checkpoint['since'] = changes['last_seq']
+                out.save(checkpoint)
 
     def run(self):
         """ Wait for a trigger ('complete' database creation) before trying to aggregate """
@@ -0,0 +1,256 @@
+""" asyncio counterparts of Client, Server and Channel. They keep the
+protocol logic of the classes they extend but replace blocking sockets,
+settimeout and time.sleep with datagram transports and event loop timers,
+so one event loop can drive many connections without a thread per role """
+import asyncio
+import time
+from .utils import *
+from .client import Client
+from .server import Server
+from .channel import Channel, Flow
+from .trace import RECV
+
+
+class DatagramEndpoint(asyncio.DatagramProtocol):
+    """ Hands every datagram received on a transport to a callback """
+    def __init__(self, on_datagram, on_error=None):
+        self.on_datagram = on_datagram
+        self.on_error = on_error
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data, addr)
+
+    def error_received(self, exc):
+        if self.on_error is not None:
+            self.on_error(exc)
+
+
+class AsyncServer(Server):
+    async def start(self, udp_ip, udp_port):
+        """ Serve until stop() is called """
+        loop = asyncio.get_running_loop()
+        self.debug(f'Starting server on {udp_ip}:{udp_port}')
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: DatagramEndpoint(self.datagram_received, self.error),
+            local_addr=('0.0.0.0', udp_port))
+        self.update_server_state(States.LISTEN)
+        self.stopped = loop.create_future()
+        try:
+            await self.stopped
+        finally:
+            self.transport.close()
+            for addr in list(self.connections):
+                self.remove_connection(addr)
+
+    def stop(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def call_later(self, delay, callback, *args):
+        return asyncio.get_running_loop().call_later(delay, callback, *args)
+
+    def sendto(self, data, addr):
+        self.transport.sendto(data, addr)
+
+
+class AsyncClient(Client):
+    async def start(self):
+        """ Start client by creating a UDP endpoint and handshaking with server """
+        loop = asyncio.get_running_loop()
+        self.debug(f'Starting client, connecting to server: {self.server_addr}')
+        self.received = asyncio.Queue()
+        self.transport, self.endpoint = await loop.create_datagram_endpoint(
+            lambda: DatagramEndpoint(
+                lambda data, addr: self.received.put_nowait((data, addr)), self.error),
+            remote_addr=self.server_addr)
+        self.linger_task = None
+        if self.probe_mtu:
+            self.use_path_mss()
+        await self.handshake()
+
+    def send_udp(self, message):
+        """ Send a message over UDP """
+        self.debug(f'Sending message over UDP: {message}')
+        self.transport.sendto(message)
+
+    def send_datagrams(self, datagrams):
+        # datagram transports take a single buffer per datagram
+        for header, payload in datagrams:
+            self.transport.sendto(header + payload)
+
+    async def recv_msg(self, timeout=None):
+        """ Wait for a message (at most timeout seconds, self.timeout by
+        default) and return header, body and addr """
+        data, addr = await asyncio.wait_for(
+            self.received.get(), self.timeout if timeout is None else timeout)
+        header = bits_to_header(data)
+        if self.trace is not None:
+            self.trace.record(RECV, header, len(data), addr[1])
+        return (header, get_body_from_data(data), addr)
+
+    async def handshake(self):
+        if self.client_state == States.CLOSED:
+            self.send_syn()
+            header, body, addr = await self.recv_msg()
+            self.handle_synack(header, body, addr)
+        else:
+            self.debug('Client state is not CLOSED; handshake already started or complete')
+
+    async def send_reliable_message(self, message, record_chunks=True):
+        return await self.send_chunks(self.message_chunks(message), record_chunks)
+
+    async def send_file(self, file, record_chunks=True):
+        with self.open_file(file) as f:
+            return await self.send_chunks(self.file_chunks(f), record_chunks)
+
+    async def send_chunks(self, chunks, record_chunks=True):
+        """ Same sliding window transfer as Client.send_chunks; the
+        retransmission timer is the timeout of the wait for the next ACK """
+        chunk_acknowledgement_times = [] if record_chunks else None
+        window = self.new_window(chunks)
+        while not window.done():
+            if not self.send_window(window, time.time()):
+                self.transport.close()
+                self.server_alive = False
+                return
+            try:
+                header, body, addr = await self.recv_msg(self.time_until_retransmit(window))
+            except asyncio.TimeoutError:
+                continue
+            self.handle_ack(window, header, body, addr, chunk_acknowledgement_times)
+
+        self.seq_num = window.next_seq
+        self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
+        return chunk_acknowledgement_times or []
+
+    async def terminate(self):
+        """ Terminate "TCP" connection using a 3 way handshake
+        (client)FIN->(server)FINACK->(client)ACK """
+        if self.client_state == States.ESTABLISHED:
+            self.send_fin()
+            header, body, addr = await self.recv_finack()
+            while header.ack and not header.fin:
+                # late ACKs for data segments may still be arriving
+                header, body, addr = await self.recv_finack()
+            if self.handle_finack(header, body, addr):
+                await self.time_wait()
+
+    async def recv_finack(self):
+        for attempt in range(self.max_retransmits):
+            try:
+                return await self.recv_msg()
+            except asyncio.TimeoutError:
+                self.debug('No FINACK, sending FIN again')
+                self.send_header(self.fin)
+        return await self.recv_msg()
+
+    async def time_wait(self):
+        """ Currently in TIME WAIT state; the transport is kept for 2 * Max
+        Segment Lifetime by a task of its own, so the caller can do other
+        work meanwhile; it must await wait_closed() before the loop ends """
+        self.debug(f'TIME_WAIT({2 * self.max_segment_lifetime}s)')
+        self.endpoint.on_datagram = self.time_wait_datagram
+        self.linger_task = asyncio.get_running_loop().create_task(self.linger())
+
+    async def linger(self):
+        try:
+            await asyncio.sleep(2 * self.max_segment_lifetime)
+        finally:
+            # also when the event loop ends first and cancels the task
+            self.debug('Closing transport')
+            self.transport.close()
+            self.closed.set()
+
+    def time_wait_datagram(self, data, addr):
+        header = bits_to_header(data)
+        if self.trace is not None:
+            self.trace.record(RECV, header, len(data), addr[1])
+        self.absorb_late_segment(header)
+
+    async def wait_closed(self):
+        if self.linger_task is not None:
+            await self.linger_task
+
+
+class AsyncChannel(Channel):
+    def open_sockets(self):
+        # endpoints are created on the event loop by run() and open_flow()
+        self.client_transport = None
+
+    async def run(self):
+        """ Relay between the clients and the server until stop() is called;
+        each message is released by an event loop timer after its delay, so
+        delays overlap instead of adding up """
+        self.loop = asyncio.get_running_loop()
+        self.client_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: DatagramEndpoint(self.from_client, self.error),
+            local_addr=('0.0.0.0', self.udp_port_channel))
+        self.stopped = self.loop.create_future()
+        self.evict_timer = self.call_later(min(self.flow_idle_timeout, 5), self.evict_idle_flows)
+        try:
+            await self.stopped
+        finally:
+            self.evict_timer.cancel()
+            self.client_transport.close()
+            for flow in self.flows.values():
+                self.close_flow(flow)
+            self.flows.clear()
+
+    def stop(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def open_flow(self, addr_client):
+        """ The upstream endpoint is created asynchronously; messages the
+        client sends before it is ready are queued on the flow """
+        flow = Flow(addr_client)
+        flow.pending = []
+        flow.opening = self.loop.create_task(self.connect_flow(flow))
+        return flow
+
+    async def connect_flow(self, flow):
+        flow.sock_server, _ = await self.loop.create_datagram_endpoint(
+            lambda: DatagramEndpoint(
+                lambda data, addr: self.from_server(flow, data), self.error),
+            remote_addr=(self.udp_ip, self.udp_port_server))
+        for data in flow.pending:
+            flow.sock_server.sendto(data)
+        flow.pending = None
+
+    def close_flow(self, flow):
+        flow.opening.cancel()
+        if flow.sock_server is not None:
+            flow.sock_server.close()
+
+    def call_later(self, delay, callback, *args):
+        return self.loop.call_later(delay, callback, *args)
+
+    def forward_to_server(self, flow, data):
+        if flow.sock_server is None:
+            flow.pending.append(data)
+        elif not flow.sock_server.is_closing():
+            flow.sock_server.sendto(data)
+
+    def from_client(self, data, addr):
+        header = self.decode(data, addr)
+        if header is None:
+            return
+        flow = self.flow_for(addr)
+        if self.drop_from_client(header, flow, len(data)):
+            return
+        channel_wait = self.delay()
+        if self.verbose:
+            self.debug(f"channel delaying client->server for {channel_wait}s")
+        self.loop.call_later(channel_wait, self.forward_to_server, flow, data)
+
+    def from_server(self, flow, data):
+        flow.last_active = self.timers.time()
+        header = self.decode(data, (self.udp_ip, self.udp_port_server))
+        if header is None or self.drop_from_server(header, flow, len(data)):
+            return
+        channel_wait = self.delay()
+        if self.verbose:
+            self.debug(f"channel delaying server->client for {channel_wait}s")
+        self.loop.call_later(channel_wait, self.client_transport.sendto, data, flow.addr_client)
+        flow.round = flow.round + 1
+        self.round = self.round + 1
@@ -0,0 +1,247 @@
+""" Batched datagram I/O: move many datagrams per system call with Linux's
+sendmmsg/recvmmsg (called through ctypes), falling back to one call per
+datagram elsewhere. Used by the blocking Client, Server and Channel, whose
+per packet system calls otherwise cap throughput at small segment sizes """
+import ctypes
+import errno
+import os
+import socket
+import struct
+import sys
+
+MSG_DONTWAIT = 0x40 # <bits/socket.h>
+SOCKADDR_STORAGE_SIZE = 128
+PyBUF_SIMPLE = 0 # <Python.h>
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+class Py_buffer(ctypes.Structure):
+    _fields_ = [
+        ('buf', ctypes.c_void_p),
+        ('obj', ctypes.c_void_p),
+        ('len', ctypes.c_ssize_t),
+        ('itemsize', ctypes.c_ssize_t),
+        ('readonly', ctypes.c_int),
+        ('ndim', ctypes.c_int),
+        ('format', ctypes.c_char_p),
+        ('shape', ctypes.POINTER(ctypes.c_ssize_t)),
+        ('strides', ctypes.POINTER(ctypes.c_ssize_t)),
+        ('suboffsets', ctypes.POINTER(ctypes.c_ssize_t)),
+        ('internal', ctypes.c_void_p),
+    ]
+
+
+def load_libc():
+    """ libc, if it has sendmmsg and recvmmsg (Linux); otherwise None """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [
+            ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def load_pythonapi():
+    """ CPython's buffer protocol functions, which give the address of a
+    read-only buffer such as a view of bytes; None on other interpreters """
+    try:
+        api = ctypes.pythonapi
+        api.PyObject_GetBuffer.argtypes = [ctypes.py_object, ctypes.POINTER(Py_buffer), ctypes.c_int]
+        api.PyBuffer_Release.argtypes = [ctypes.POINTER(Py_buffer)]
+    except AttributeError:
+        return None
+    return api
+
+
+LIBC = load_libc()
+PYTHONAPI = load_pythonapi()
+
+
+class DatagramBatch:
+    """ Preallocated buffers to send and receive up to batch_size datagrams
+    at once. Received datagrams are views of these buffers, valid until the
+    next recv() """
+    def __init__(self, batch_size=64, buffer_size=65535, native=True):
+        """ native: use sendmmsg/recvmmsg where available; False forces the
+        per datagram fallback """
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.native = native and LIBC is not None
+        self.buffers = [bytearray(buffer_size) for _ in range(batch_size)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        if self.native:
+            self.setup_native()
+
+    def setup_native(self):
+        self.recv_msgs = (mmsghdr * self.batch_size)()
+        self.recv_iov = (iovec * self.batch_size)()
+        self.recv_names = (ctypes.c_char * (SOCKADDR_STORAGE_SIZE * self.batch_size))()
+        # keep the exported ctypes views of the buffers alive with the batch
+        self.recv_c_buffers = [
+            (ctypes.c_char * self.buffer_size).from_buffer(buffer) for buffer in self.buffers]
+        names = ctypes.addressof(self.recv_names)
+        for i, c_buffer in enumerate(self.recv_c_buffers):
+            self.recv_iov[i].iov_base = ctypes.addressof(c_buffer)
+            self.recv_iov[i].iov_len = self.buffer_size
+            hdr = self.recv_msgs[i].msg_hdr
+            hdr.msg_name = names + i * SOCKADDR_STORAGE_SIZE
+            hdr.msg_iov = ctypes.pointer(self.recv_iov[i])
+            hdr.msg_iovlen = 1
+        self.send_msgs = (mmsghdr * self.batch_size)()
+        self.sockaddrs = {} # addr -> packed sockaddr, addresses are resolved once
+
+    def recv(self, sock):
+        """ Datagrams waiting on sock, as a list of (view, addr); never blocks,
+        an empty list means there is nothing to read """
+        if not self.native:
+            return self.recv_fallback(sock)
+        for msg in self.recv_msgs:
+            msg.msg_hdr.msg_namelen = SOCKADDR_STORAGE_SIZE
+        count = LIBC.recvmmsg(
+            sock.fileno(), ctypes.addressof(self.recv_msgs), self.batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise_errno(error)
+        return [
+            (self.views[i][:self.recv_msgs[i].msg_len],
+             unpack_sockaddr(self.recv_names, i * SOCKADDR_STORAGE_SIZE))
+            for i in range(count)]
+
+    def recv_fallback(self, sock):
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        datagrams = []
+        try:
+            for view in self.views:
+                try:
+                    nbytes, addr = sock.recvfrom_into(view)
+                except BlockingIOError:
+                    break
+                datagrams.append((view[:nbytes], addr))
+        finally:
+            sock.settimeout(timeout)
+        return datagrams
+
+    def send(self, sock, datagrams):
+        """ Send datagrams, a list of (buffers, addr) where the buffers of one
+        datagram are sent back to back (e.g. header and payload) """
+        if not self.native:
+            for buffers, addr in datagrams:
+                if hasattr(sock, 'sendmsg'):
+                    sock.sendmsg(buffers, [], 0, addr)
+                else:
+                    sock.sendto(b''.join(buffers), addr)
+            return
+        for start in range(0, len(datagrams), self.batch_size):
+            self.send_native(sock, datagrams[start:start + self.batch_size])
+
+    def send_native(self, sock, datagrams):
+        keep_alive = [] # buffers and structures that must outlive the system call
+        exported = [] # buffers to release once sent
+        try:
+            for msg, (buffers, addr) in zip(self.send_msgs, datagrams):
+                iov = (iovec * len(buffers))()
+                for entry, buffer in zip(iov, buffers):
+                    entry.iov_base = buffer_address(buffer, keep_alive, exported)
+                    entry.iov_len = len(buffer)
+                keep_alive.append(iov)
+                name = self.sockaddr(sock, addr)
+                hdr = msg.msg_hdr
+                hdr.msg_name = ctypes.addressof(name)
+                hdr.msg_namelen = len(name)
+                hdr.msg_iov = iov
+                hdr.msg_iovlen = len(buffers)
+            sent = 0
+            while sent < len(datagrams):
+                count = LIBC.sendmmsg(
+                    sock.fileno(), ctypes.addressof(self.send_msgs) + sent * ctypes.sizeof(mmsghdr),
+                    len(datagrams) - sent, 0)
+                if count < 0:
+                    raise_errno(ctypes.get_errno())
+                sent += count
+        finally:
+            for view in exported:
+                PYTHONAPI.PyBuffer_Release(ctypes.byref(view))
+
+    def sockaddr(self, sock, addr):
+        name = self.sockaddrs.get(addr)
+        if name is None:
+            family, _, _, _, resolved = socket.getaddrinfo(
+                addr[0], addr[1], sock.family, socket.SOCK_DGRAM)[0]
+            packed = pack_sockaddr(family, resolved)
+            name = ctypes.create_string_buffer(packed, len(packed))
+            self.sockaddrs[addr] = name
+        return name
+
+
+def buffer_address(buffer, keep_alive, exported):
+    """ Address of the bytes of buffer (bytes, bytearray or a contiguous
+    memoryview of either), taken in place; what has to outlive the system
+    call goes to keep_alive, buffers exported through the buffer protocol
+    to exported, to be released after it """
+    if isinstance(buffer, bytes):
+        keep_alive.append(buffer)
+        return ctypes.cast(ctypes.c_char_p(buffer), ctypes.c_void_p).value
+    if not memoryview(buffer).readonly:
+        c_buffer = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+        keep_alive.append(c_buffer)
+        return ctypes.addressof(c_buffer)
+    if PYTHONAPI is not None:
+        # e.g. a chunk of an encoded message: a view into bytes, which
+        # ctypes only maps from its start
+        view = Py_buffer()
+        PYTHONAPI.PyObject_GetBuffer(buffer, ctypes.byref(view), PyBUF_SIMPLE)
+        exported.append(view)
+        return view.buf
+    buffer = bytes(buffer)
+    keep_alive.append(buffer)
+    return ctypes.cast(ctypes.c_char_p(buffer), ctypes.c_void_p).value
+
+
+def pack_sockaddr(family, addr):
+    if family == socket.AF_INET:
+        return struct.pack('=H', family) + struct.pack('!H', addr[1]) + \
+            socket.inet_aton(addr[0]) + bytes(8)
+    host, port, flowinfo, scope_id = addr
+    return struct.pack('=H', family) + struct.pack('!HI', port, flowinfo) + \
+        socket.inet_pton(socket.AF_INET6, host) + struct.pack('=I', scope_id)
+
+
+def unpack_sockaddr(names, offset):
+    family, = struct.unpack_from('=H', names, offset)
+    if family == socket.AF_INET:
+        port, = struct.unpack_from('!H', names, offset + 2)
+        return (socket.inet_ntoa(names[offset + 4:offset + 8]), port)
+    port, flowinfo = struct.unpack_from('!HI', names, offset + 2)
+    scope_id, = struct.unpack_from('=I', names, offset + 24)
+    return (socket.inet_ntop(socket.AF_INET6, names[offset + 8:offset + 24]), port, flowinfo, scope_id)
+
+
+def raise_errno(error):
+    # OSError picks the matching subclass, e.g. ConnectionRefusedError
+    raise OSError(error, os.strerror(error))
@@ -1,10 +1,30 @@
 
 import threading
 import random
+import selectors
 import socket
-import time
 import logging
 from .utils import *
+from .timers import TimerQueue
+from .batchio import DatagramBatch
+from .trace import RECV, DROP
+
+# large enough for any UDP datagram, the channel does not know the MSS in use
+MAX_DATAGRAM_SIZE = 65535
+
+
+class Flow:
+    """ One client <-> server flow relayed by the channel. Like a NAT
+    mapping, every client address gets its own upstream socket, so the
+    server sees each client as a distinct peer and its replies can be
+    routed back to the client that the flow belongs to """
+    def __init__(self, addr_client, sock_server=None):
+        self.addr_client = addr_client
+        self.sock_server = sock_server # upstream socket (or transport) towards the server
+        self.round = 0 # used for some startup synchronization
+        self.teardown_started = False # flag used to not drop messages once teardown has started
+        self.last_active = 0
+
 
 class Channel:
     def __init__(self,
@@ -15,7 +35,11 @@ class Channel:
         sleep_v=0.05,
         sleep_factor=4,
         p_drop_server=0,
-        p_drop_client=0):
+        p_drop_client=0,
+        flow_idle_timeout=60,
+        batch_io=True,
+        trace=None,
+        metrics=None):
         self.udp_ip = udp_ip
         self.udp_port_channel = udp_port_channel
         self.udp_port_server = udp_port_server
@@ -23,29 +47,43 @@ class Channel:
         self.sleep_factor = sleep_factor
         self.p_drop_client = p_drop_client
         self.p_drop_server = p_drop_server
+        self.flow_idle_timeout = flow_idle_timeout # forget flows silent for this long
+        self.batch_io = batch_io
+        self.trace = trace # PacketTrace recording every message relayed or dropped, or None
 
         self.setup_logging(verbose=verbose)
+        self.open_sockets()
+
+        # used to stop the event loop if needed (from another thread, etc.)
+        self.event_terminate = threading.Event()
+        # messages waiting out their delay, released by the event loop
+        self.timers = TimerQueue()
+        self.round = 0 # rounds of communication across all flows
+        self.round_startup = 2 # number of rounds of communication to wait before dropping messages (so connection is established)
+        # mapping table: one flow per client address
+        self.flows = {}
+        self.server_ack_drop_count = 0
+        self.client_msg_drop_count = 0
+        self.metrics = metrics # MetricsRegistry updated as messages are relayed, or None
+        if metrics is not None:
+            self.setup_metrics(metrics)
+
+    def open_sockets(self):
         # socket for client <-> channel communication
         self.sock_client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
         # self.sock_client.bind((self.udp_ip, self.udp_port_channel))
         self.sock_client.bind(('', self.udp_port_channel ))
+        # with udp_port_channel 0 the OS picks a free port
+        self.udp_port_channel = self.sock_client.getsockname()[1]
 
-        # socket for channel <-> server communication
-        self.sock_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
+        # polled by a selector, never block on it; the sockets for
+        # channel <-> server communication are opened per flow
+        self.sock_client.setblocking(False)
 
-        # timeouts to prevent socket recvs from potentially hanging
-        self.sock_client.settimeout(3.0)
-        self.sock_server.settimeout(3.0)
-
-        # used to terminate threads if needed (on ctrl+c, etc.)
-        self.event_terminate = threading.Event()
-        self.round = 0 # used for some startup synchronization
-        self.event_wait_send = threading.Event() # used for some recurring synchronization ordering sends/recvs
-        self.teardown_started = False # flag used to not drop messages once teardown has started
-        self.round_startup = 2 # number of rounds of communication to wait before dropping messages (so connection is established)
-        self.addr_client = [] # client address information, used so channel can send back to client
-        self.server_ack_drop_count = 0
-        self.client_msg_drop_count = 0
+        # every socket is read, and messages released at the same time are
+        # sent, in as few system calls as the platform allows
+        self.batch = DatagramBatch(batch_size=32, buffer_size=MAX_DATAGRAM_SIZE, native=self.batch_io)
+        self.outbox = {} # socket -> datagrams to send on it
 
     def setup_logging(self, verbose):
         """ set up self.logger for producer logging """
@@ -54,14 +92,28 @@ class Channel:
         handler = logging.StreamHandler()
         handler.setFormatter(formatter)
         self.prefix = {'prefix': 'Channel'}
-        self.logger.addHandler(handler)
+        if not self.logger.handlers:
+            # several instances in one process (e.g. bench.py) share the logger
+            self.logger.addHandler(handler)
         self.logger = logging.LoggerAdapter(self.logger, self.prefix)
+        # per message debug messages are not even formatted unless verbose
+        self.verbose = verbose
         if verbose:
             self.logger.setLevel(logging.DEBUG)
             self.logger.debug('Debug mode enabled', extra=self.prefix)
         else:
             self.logger.setLevel(logging.INFO)
 
+    def setup_metrics(self, metrics):
+        """ Create the channel's metrics in the registry """
+        self.metric_messages = {direction: metrics.counter(
+            'channel_messages_total', 'messages received by the channel', direction=direction)
+            for direction in ('client_to_server', 'server_to_client')}
+        self.metric_dropped = {direction: metrics.counter(
+            'channel_dropped_total', 'messages dropped by the channel', direction=direction)
+            for direction in ('client_to_server', 'server_to_client')}
+        metrics.gauge('channel_flows', 'clients with a flow open', fn=lambda: len(self.flows))
+
     def debug(self, msg):
         self.logger.debug(msg, extra=self.prefix)
 
@@ -71,125 +123,201 @@ class Channel:
     def error(self, msg):
         self.logger.error(msg, extra=self.prefix)
 
-    def chan_client(self):
-        while True:
-            if self.event_terminate.is_set():
-                self.info("self.event_terminate is set; break from loop")
-                break
-
-            self.info('waiting on client')
-
-            try:
-                data_client, self.addr_client = self.sock_client.recvfrom(1024)
-            except socket.timeout:
-                # this was not needed on python 3.8+
-                # on python 3.7.x, this exception is needed to prevent hangs
-                # probably a concurrency bug or relationship of timeout values
-                # in client/server implementations
-                # for this case, the message truly is lost, but
-                # if client/server implement reliable transfer
-                # (e.g., stop and wait), should be okay (was in our solution
-                # at least tested with 50% message/ack loss probability
-                # with success)
-                # the same exception has been added on the server channel for the
-                # same reasoning
-                #
-                # note: these timeouts can occur if enough msgs/acks are dropped in a row
-                # but if client/server resend is working properly, should not matter
-                self.error('EXCEPTION: client channel timeout, message lost')
-                continue
-
-            header = bits_to_header(data_client)
-
-            channel_wait = random.uniform(self.sleep_v,self.sleep_factor * self.sleep_v)
-            time.sleep(channel_wait)
-            self.info(f"channel delaying client->server for {channel_wait}s")
-
-            if header.fin == 1:
-                self.teardown_started = True
-
-            # drop messages randomly, after connection established
-            # avoid dropping connection establishment and teardown messages
-            if self.round >= self.round_startup and \
-                (header.ack == 0 and header.syn == 0 and header.fin == 0) and \
-                random.uniform(0.0,1.0) <= self.p_drop_client and \
-                not self.teardown_started:
-
-                self.info("DROPPING MESSAGE FROM CLIENT")
-                self.client_msg_drop_count += 1
+    def from_client(self):
+        """ Read every message the clients have sent and schedule their
+        release to the server """
+        for data_client, addr_client in self.drain(self.sock_client):
+            # decoded first, so a stray datagram does not open a flow
+            header = self.decode(data_client, addr_client)
+            if header is None:
                 continue
-
-            self.info('channel forwarding to server')
-            self.sock_server.sendto(data_client, (self.udp_ip, self.udp_port_server))
-            time.sleep(self.sleep_v)
-
-            # notify that server has sent without dropping, needed for ordering sends/receives, otherwise can hang
-            self.event_wait_send.set()
-
-    # server listener/sender, forwards server messages to client
-    def chan_server(self):
-        while True:
-            if self.event_terminate.is_set():
-                break
-
-            self.info('waiting on server response (can hang if server does not resend)')
-
-            # primitive synchronization
-            # need to wait until initial client message sent
-            # to server, otherwise socket from server
-            # is not valid (so sock_server.recvfrom will error)
-            self.event_wait_send.wait()
-
-            self.event_wait_send.clear()
-
-            try:
-                data_server, addr_server = self.sock_server.recvfrom(1024)
-            except socket.timeout:
-                self.error('EXCEPTION: server channel timeout, message lost')
+            flow = self.flow_for(addr_client)
+            if self.drop_from_client(header, flow, len(data_client)):
                 continue
-
-            header = bits_to_header(data_server)
-
-            # drop messages randomly
-            # avoids dropping connection establishment and teardown messages
-            if self.round >= self.round_startup and \
-                (header.ack == 1 and header.syn == 0 and header.fin == 0) and \
-                    random.uniform(0.0,1.0) <= self.p_drop_server and \
-                        not self.teardown_started:
-                self.info("DROPPING ACK FROM SERVER")
-                self.server_ack_drop_count += 1
+            channel_wait = self.delay()
+            if self.verbose:
+                self.debug(f"channel delaying client->server for {channel_wait}s")
+            self.call_later(
+                channel_wait, self.forward, flow.sock_server,
+                data_client, (self.udp_ip, self.udp_port_server))
+
+    def flow_for(self, addr_client):
+        """ Look up the flow of a client, opening one for a new client """
+        flow = self.flows.get(addr_client)
+        if flow is None:
+            flow = self.open_flow(addr_client)
+            self.flows[addr_client] = flow
+            self.debug(f'New flow for {addr_client}; {len(self.flows)} flows open')
+        flow.last_active = self.timers.time()
+        return flow
+
+    def open_flow(self, addr_client):
+        flow = Flow(addr_client)
+        # bound right away so it can be polled before the first message is
+        # forwarded to the server
+        flow.sock_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # UDP
+        flow.sock_server.bind(('', 0))
+        flow.sock_server.setblocking(False)
+        self.selector.register(
+            flow.sock_server, selectors.EVENT_READ, lambda: self.from_server(flow))
+        return flow
+
+    def close_flow(self, flow):
+        self.selector.unregister(flow.sock_server)
+        flow.sock_server.close()
+
+    def evict_idle_flows(self):
+        """ Forget flows that have been silent for flow_idle_timeout seconds;
+        a late message for one of them is then lost, as with an expired
+        NAT mapping """
+        now = self.timers.time()
+        for addr_client, flow in list(self.flows.items()):
+            if now - flow.last_active >= self.flow_idle_timeout:
+                self.debug(f'Flow for {addr_client} idle, evicting')
+                del self.flows[addr_client]
+                self.close_flow(flow)
+        self.evict_timer = self.call_later(min(self.flow_idle_timeout, 5), self.evict_idle_flows)
+
+    def call_later(self, delay, callback, *args):
+        return self.timers.call_later(delay, callback, *args)
+
+    def decode(self, data, addr):
+        """ Header of a message to relay; None, once logged, for a datagram
+        that is not a segment, which is then not relayed """
+        try:
+            return bits_to_header(data)
+        except ValueError as e:
+            # a stray datagram must not take down the flows of every client
+            self.error(f'Dropping malformed message of {len(data)} bytes from {addr}: {e}')
+            return None
+
+    def delay(self):
+        """ Random propagation delay for one message """
+        return random.uniform(self.sleep_v, self.sleep_factor * self.sleep_v)
+
+    def drop_from_client(self, header, flow, length=0):
+        """ Decide whether a message (of length bytes) from the client of
+        flow is lost """
+        if self.trace is not None:
+            self.trace.record(RECV, header, length, flow.addr_client[1])
+        if self.metrics is not None:
+            self.metric_messages['client_to_server'].inc()
+        if header.fin == 1:
+            flow.teardown_started = True
+
+        # drop messages randomly, after connection established
+        # avoid dropping connection establishment and teardown messages
+        if flow.round >= self.round_startup and \
+            (header.ack == 0 and header.syn == 0 and header.fin == 0) and \
+            random.uniform(0.0,1.0) <= self.p_drop_client and \
+            not flow.teardown_started:
+
+            self.info("DROPPING MESSAGE FROM CLIENT")
+            self.client_msg_drop_count += 1
+            if self.metrics is not None:
+                self.metric_dropped['client_to_server'].inc()
+            if self.trace is not None:
+                self.trace.record(DROP, header, length, flow.addr_client[1])
+            return True
+        return False
+
+    def drop_from_server(self, header, flow, length=0):
+        """ Decide whether an ACK (of length bytes) from the server to the
+        client of flow is lost """
+        if self.trace is not None:
+            self.trace.record(RECV, header, length, flow.addr_client[1])
+        if self.metrics is not None:
+            self.metric_messages['server_to_client'].inc()
+        # drop messages randomly
+        # avoids dropping connection establishment and teardown messages
+        if flow.round >= self.round_startup and \
+            (header.ack == 1 and header.syn == 0 and header.fin == 0) and \
+                random.uniform(0.0,1.0) <= self.p_drop_server and \
+                    not flow.teardown_started:
+            self.info("DROPPING ACK FROM SERVER")
+            self.server_ack_drop_count += 1
+            if self.metrics is not None:
+                self.metric_dropped['server_to_client'].inc()
+            if self.trace is not None:
+                self.trace.record(DROP, header, length, flow.addr_client[1])
+            return True
+        return False
+
+    # server listener, schedules server messages for the client of flow
+    def from_server(self, flow):
+        for data_server, addr_server in self.drain(flow.sock_server):
+            flow.last_active = self.timers.time()
+            header = self.decode(data_server, addr_server)
+            if header is None or self.drop_from_server(header, flow, len(data_server)):
                 continue
-
-            self.info(f'channel forwarding to client (addr = {self.addr_client[1]}')
-
-            channel_wait = random.uniform(self.sleep_v, self.sleep_factor * self.sleep_v)
-            time.sleep(channel_wait)
-            self.info(f"channel delaying server->client for {channel_wait}s")
-
-            self.sock_client.sendto(data_server, (self.addr_client[0], self.addr_client[1]))
-            time.sleep(self.sleep_v)
+            channel_wait = self.delay()
+            if self.verbose:
+                self.debug(f"channel delaying server->client for {channel_wait}s")
+            self.call_later(
+                channel_wait, self.forward, self.sock_client,
+                data_server, flow.addr_client)
+            flow.round = flow.round + 1
             self.round = self.round + 1
 
-    def run(self):
-        t_client = threading.Thread(target=self.chan_client)
-        t_server = threading.Thread(target=self.chan_server)
-        t_client.start()
-        time.sleep(2)
-        t_server.start()
-        # main loop for keeping client/server threads running and termination handling
+    def drain(self, sock):
+        """ Yield (data, addr) for every datagram waiting on a non-blocking socket """
         while True:
             try:
-                time.sleep(5)
-                self.info(f"round: {self.round} ongoing; waiting 5s (threads sampled faster)")
-                self.info("") # newline
+                datagrams = self.batch.recv(sock)
+            except OSError as e:
+                # e.g. ICMP port unreachable from a previous send; the message is lost
+                self.error(f'EXCEPTION: {e}, message lost')
+                return
+            if not datagrams:
+                return
+            for data, addr in datagrams:
+                # copied out of the batch buffers, the message is held until its delay is over
+                yield bytes(data), addr
+
+    def forward(self, sock, data, addr):
+        """ A message has waited out its delay; send it on with the other
+        messages released at the same time """
+        self.outbox.setdefault(sock, []).append(((data,), addr))
+
+    def flush(self):
+        for sock, datagrams in self.outbox.items():
+            try:
+                self.batch.send(sock, datagrams)
+            except OSError as e:
+                self.error(f'EXCEPTION: {e}, {len(datagrams)} messages lost')
+        self.outbox.clear()
 
-                if not t_client.is_alive() or not t_server.is_alive():
-                    self.info("shutting down channel; client/server threads not running")
-                    self.event_terminate.set()
-                    break
-            except Exception as e:
-                self.error(e)
-                self.event_terminate.set()
-                break
+    def report(self):
+        self.info(f"round: {self.round} ongoing; {len(self.flows)} flows; "
+            f"{len(self.timers)} messages in flight")
+        self.timers.call_later(5, self.report)
 
+    def stop(self):
+        self.event_terminate.set()
 
+    def run(self):
+        """ Single threaded event loop: a selector wakes the loop when either
+        side sends, and the timer heap releases each message once its own
+        delay has passed. Messages are delayed independently, so the delay
+        of one does not hold up the others, and both directions are
+        forwarded as soon as they are due """
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock_client, selectors.EVENT_READ, self.from_client)
+        self.timers.call_later(5, self.report)
+        self.evict_timer = self.call_later(min(self.flow_idle_timeout, 5), self.evict_idle_flows)
+        try:
+            while not self.event_terminate.is_set():
+                # wake up for the next release at the latest, and regularly
+                # enough to notice event_terminate
+                for key, _ in self.selector.select(self.timers.timeout(maximum=1.0)):
+                    key.data()
+                self.timers.run_due()
+                self.flush()
+        except KeyboardInterrupt:
+            self.info("shutting down channel")
+        finally:
+            for flow in self.flows.values():
+                self.close_flow(flow)
+            self.flows.clear()
+            self.selector.close()
+            self.sock_client.close()
@@ -1,9 +1,15 @@
 from .utils import *
+from .window import SlidingWindow
+from .rto import RTOEstimator
+from .congestion import CONGESTION_CONTROLS
+from .batchio import DatagramBatch
+from .trace import SEND, RECV, RESEND
+import contextlib
 import socket
+import threading
 import time
 import csv
 import logging
-import couchdb
 from datetime import datetime
 
 class Client:
@@ -13,7 +19,11 @@ class Client:
         channel_p_drop_server=0,
         channel_p_drop_client=0,
         server_udp_ip='127.0.0.1', server_udp_port=5005,
-        max_segment_size=12, timeout=1, verbose=False):
+        max_segment_size=12, timeout=1,
+        transfer_mode='gbn', window_size=1,
+        min_rto=0.2, max_rto=10.0, max_retransmits=30, congestion='none',
+        probe_mtu=False, max_segment_lifetime=5, batch_io=True, trace=None, metrics=None,
+        telemetry=None, verbose=False):
 
         self.setup_logging(verbose=verbose)
         # Save channel properties to include in data dump process
@@ -24,27 +34,28 @@ class Client:
 
         self.client_state = States.CLOSED
         self.server_addr = (server_udp_ip, server_udp_port)
-        self.max_segment_size = max_segment_size # max num bytes client can receive or send in single segment
-        self.timeout = timeout
-
-    def connect_couchdb(self):
-        # couchdb connection
-        self.debug(
-            f'Connecting to CouchDB server at: http://{self.couchdb_user}:{self.couchdb_password}@{self.couchdb_server}/"')
-        self.couch = couchdb.Server(
-            f"http://{self.couchdb_user}:{self.couchdb_password}@{self.couchdb_server}/")
-        # create the database if not existing, get the database if already existing
-        try:
-            self.db = self.couch.create(self.couchdb_database)
-            self.debug(
-                f"Successfully created new CouchDB database {self.couchdb_database}")
-        except:
-            self.db = self.couch[self.couchdb_database]
-            self.debug(
-                f"Successfully connected to existing CouchDB database {self.couchdb_database}")
-
-    def database_exists(self, database):
-        return database in self.couch
+        self.max_segment_size = max_segment_size # max num bytes client can receive or send in single segment; lowered to the server's in the handshake
+        self.probe_mtu = probe_mtu # also keep segments within the path MTU to the server
+        self.recv_buffer = bytearray(MAX_HEADER_SIZE + max_segment_size)
+        # moves a window's worth of segments / ACKs per system call (Linux)
+        self.batch = DatagramBatch(buffer_size=MAX_HEADER_SIZE + max_segment_size, native=batch_io)
+        self.timeout = timeout # socket timeout for handshake/teardown, and the initial RTO
+        # retransmission timeout is estimated from measured RTTs (RFC 6298)
+        self.rto = RTOEstimator(initial_rto=timeout, min_rto=min_rto, max_rto=max_rto)
+        self.max_retransmits = max_retransmits # give up on a segment after this many resends
+        self.transfer_mode = transfer_mode # 'gbn' (Go-Back-N) or 'sr' (Selective Repeat)
+        self.window_size = window_size # max number of unacknowledged segments in flight
+        # congestion window (bytes in flight), kept for the whole connection
+        self.congestion = CONGESTION_CONTROLS[congestion](mss=max_segment_size)
+        self.max_segment_lifetime = max_segment_lifetime # TIME_WAIT lasts twice this
+        self.final_ack = None # resent during TIME_WAIT if the server repeats its FINACK
+        self.closed = threading.Event() # set once TIME_WAIT is over and the socket closed
+        self.linger_thread = None # keeps the socket during TIME_WAIT
+        self.trace = trace # PacketTrace recording every segment sent and received, or None
+        self.metrics = metrics # MetricsRegistry updated live during transfers, or None
+        if metrics is not None:
+            self.setup_metrics(metrics)
+        self.telemetry = telemetry # started TelemetryExporter each chunk record is submitted to, or None
 
     def setup_logging(self, verbose):
         """ set up self.logger for producer logging """
@@ -53,14 +64,42 @@ class Client:
         handler = logging.StreamHandler()
         handler.setFormatter(formatter)
         self.prefix = {'prefix': 'Client'}
-        self.logger.addHandler(handler)
+        if not self.logger.handlers:
+            # several instances in one process (e.g. bench.py) share the logger
+            self.logger.addHandler(handler)
         self.logger = logging.LoggerAdapter(self.logger, self.prefix)
+        # per segment debug messages are not even formatted unless verbose
+        self.verbose = verbose
         if verbose:
             self.logger.setLevel(logging.DEBUG)
             self.logger.debug('Debug mode enabled', extra=self.prefix)
         else:
             self.logger.setLevel(logging.INFO)
 
+    def setup_metrics(self, metrics):
+        """ Create the client's metrics in the registry """
+        self.metric_segments_sent = metrics.counter(
+            'client_segments_sent_total', 'PSH segments sent, including retransmissions')
+        self.metric_retransmits = {reason: metrics.counter(
+            'client_retransmits_total', 'segments resent, by what detected the loss', reason=reason)
+            for reason in ('timeout', 'fast')}
+        self.metric_dup_acks = metrics.counter(
+            'client_duplicate_acks_total', 'ACKs that did not advance the window')
+        self.metric_bytes_acked = metrics.counter(
+            'client_bytes_acked_total', 'payload bytes acknowledged by the server')
+        self.metric_rtt = metrics.histogram(
+            'client_rtt_seconds', 'round trip times sampled for the retransmission timeout')
+        self.metric_chunk_latency = metrics.histogram(
+            'client_chunk_latency_seconds', 'time from first sending a chunk to its ACK (time_to_ack)')
+        self.metric_bytes_in_flight = metrics.gauge(
+            'client_bytes_in_flight', 'payload bytes sent and not yet acknowledged')
+        self.metric_goodput = metrics.gauge(
+            'client_goodput_bytes_per_second', 'payload bytes acknowledged per second in the current transfer')
+        metrics.gauge('client_cwnd_bytes', 'congestion window (NaN without congestion control)',
+            fn=lambda: self.congestion.snapshot()['cwnd'])
+        metrics.gauge('client_rto_seconds', 'current retransmission timeout',
+            fn=lambda: self.rto.rto)
+
     def debug(self, msg):
         self.logger.debug(msg, extra=self.prefix)
 
@@ -76,6 +115,8 @@ class Client:
         self.sock = socket.socket(socket.AF_INET,    # Internet
                             socket.SOCK_DGRAM)  # UDP
         self.sock.settimeout(self.timeout)
+        if self.probe_mtu:
+            self.use_path_mss()
         self.handshake()
 
     def send_udp(self, message):
@@ -83,222 +124,409 @@ class Client:
         self.debug(f'Sending message over UDP: {message}')
         self.sock.sendto(message, self.server_addr)
 
+    def send_header(self, header):
+        """ Send a segment without payload """
+        data = header.bits()
+        if self.trace is not None:
+            self.trace.record(SEND, header, len(data), self.server_addr[1])
+        self.send_udp(data)
+
+    def send_datagrams(self, datagrams):
+        """ Send (header, payload) pairs as datagrams without joining header
+        and payload, in as few system calls as the platform allows """
+        self.batch.send(self.sock, [((header, payload), self.server_addr) for header, payload in datagrams])
+
     def handshake(self):
         if self.client_state == States.CLOSED:
-            self.seq_num = rand_int()
-            syn_header = Header(
-                seq_num=self.seq_num,
-                syn=1,
-                mss=12
-                )
-            # for this case we send only header;
-            # if you need to send data you will need to append it
-            # Step 1, init handshake
-            self.info("\nSENDING HANDSHAKE")
-            self.debug(syn_header)
-            self.send_udp(syn_header.bits())
-            self.update_state(States.SYN_SENT)
-
+            self.send_syn()
             # wait for SYN-ACK from server (step 2)
             header, body, addr = self.recv_msg()
-            self.debug("\nRECEIVED")
-            self.debug(f'{header} {body} {addr}')
-            if header.syn and header.ack: ## SYN-ACK
-                self.update_state(States.SYNACK_RECEIVED)
-                # Respond with ACK (step 3)
-                self.seq_num = header.ack_num
-                self.ack_num = header.seq_num + 1
-                ack_header = Header(
-                    ack=1,
-                    seq_num=self.seq_num,
-                    ack_num=self.ack_num
-                    )
-                self.debug("\nSENDING")
-                self.debug(ack_header)
-                self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
-                self.sock.sendto(ack_header.bits(), self.server_addr)
-                self.update_state(States.ACK_SENT)
-                self.update_state(States.ESTABLISHED)
-            else:
-                self.debug('Not SYNACK')
+            self.handle_synack(header, body, addr)
         else:
             self.debug('Client state is not CLOSED; handshake already started or complete')
 
+    def use_path_mss(self):
+        """ Lower the MSS to what fits in the path MTU to the server """
+        path_mss = probe_path_mss(self.server_addr)
+        if path_mss is None:
+            self.debug('Path MTU unknown on this platform, keeping MSS')
+        elif path_mss < self.max_segment_size:
+            self.debug(f'Path MTU allows an MSS of {path_mss}')
+            self.max_segment_size = path_mss
+
+    def send_syn(self):
+        """ Step 1, init handshake """
+        self.seq_num = rand_int()
+        syn_header = Header(
+            seq_num=self.seq_num,
+            syn=1,
+            mss=self.max_segment_size
+            )
+        # for this case we send only header;
+        # if you need to send data you will need to append it
+        self.info("\nSENDING HANDSHAKE")
+        self.debug(syn_header)
+        self.send_header(syn_header)
+        self.update_state(States.SYN_SENT)
+
+    def handle_synack(self, header, body, addr):
+        """ Step 2 received; respond with ACK (step 3) """
+        self.debug("\nRECEIVED")
+        self.debug(f'{header} {body} {addr}')
+        if header.syn and header.ack: ## SYN-ACK
+            self.update_state(States.SYNACK_RECEIVED)
+            self.negotiate_mss(header.mss)
+            # Respond with ACK (step 3)
+            self.seq_num = header.ack_num
+            self.ack_num = header.seq_num + 1
+            ack_header = Header(
+                ack=1,
+                seq_num=self.seq_num,
+                ack_num=self.ack_num
+                )
+            self.debug("\nSENDING")
+            self.debug(ack_header)
+            self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
+            self.send_header(ack_header)
+            self.update_state(States.ACK_SENT)
+            self.update_state(States.ESTABLISHED)
+        else:
+            self.debug('Not SYNACK')
+
+    def recv_pending(self):
+        """ Messages already waiting on the socket, without blocking """
+        for data, addr in self.batch.recv(self.sock):
+            header = bits_to_header(data)
+            if self.trace is not None:
+                self.trace.record(RECV, header, len(data), addr[1])
+            yield (header, get_body_from_data(data), addr)
+
+    def negotiate_mss(self, server_mss):
+        """ Segments must fit the server's buffers as well as ours """
+        if server_mss < self.max_segment_size:
+            self.debug(f'Server MSS is {server_mss}, lowering ours from {self.max_segment_size}')
+            self.max_segment_size = server_mss
+            # the congestion window is counted in segments of the new size
+            self.congestion = type(self.congestion)(mss=server_mss)
+
     def recv_msg(self):
         """ Receive a message and return header, body and addr; addr
-        is used to reply to the client; this call is blocking """
-        data, addr = self.sock.recvfrom(1024)
+        is used to reply to the client; this call is blocking. The body is
+        a view of the receive buffer, valid until the next call """
+        nbytes, addr = self.sock.recvfrom_into(self.recv_buffer)
+        data = memoryview(self.recv_buffer)[:nbytes]
         header = bits_to_header(data)
         body = get_body_from_data(data)
+        if self.trace is not None:
+            self.trace.record(RECV, header, nbytes, addr[1])
         return (header, body, addr)
 
     def terminate(self):
         """ Terminate "TCP" connection using a 3 way handshake
         (client)FIN->(server)FINACK->(client)ACK """
         if self.client_state == States.ESTABLISHED:
-            fin_header = Header(
+            self.send_fin()
+            header, body, addr = self.recv_finack()
+            while header.ack and not header.fin:
+                # late ACKs for data segments may still be arriving
+                header, body, addr = self.recv_finack()
+            if self.handle_finack(header, body, addr):
+                self.time_wait()
+
+    def recv_finack(self):
+        """ Receive the next segment, sending the FIN again each time none
+        arrives in time (the FIN or the FINACK was lost) """
+        for attempt in range(self.max_retransmits):
+            try:
+                return self.recv_msg()
+            except socket.timeout:
+                self.debug('No FINACK, sending FIN again')
+                self.send_header(self.fin)
+        return self.recv_msg()
+
+    def send_fin(self):
+        self.fin = Header(
+            seq_num=self.seq_num,
+            ack_num=self.ack_num,
+            fin=1
+        )
+        self.debug("\nSENDING")
+        self.debug(self.fin)
+        self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
+        self.send_header(self.fin)
+        self.update_state(States.FIN_SENT)
+        self.debug('Waiting for FINACK from server')
+
+    def handle_finack(self, header, body, addr):
+        """ Acknowledge the server's FINACK; return True once in TIME_WAIT """
+        self.debug("\nRECEIVED")
+        self.debug(f'{header} {body} {addr}')
+        self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
+        if header.ack == 1 and header.fin == 1:
+            self.update_state(States.FINACK_RECEIVED)
+            self.debug("Acknowledging FINACK (step 4)")
+            self.seq_num = header.ack_num
+            self.ack_num = header.seq_num + 1
+            self.final_ack = Header(
                 seq_num=self.seq_num,
                 ack_num=self.ack_num,
-                fin=1
+                ack=1,
             )
             self.debug("\nSENDING")
-            self.debug(fin_header)
-            self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
-            self.send_udp(fin_header.bits())
-            self.update_state(States.FIN_SENT)
-            self.debug('Waiting for FINACK from server')
-            header, body, addr = self.recv_msg()
-            self.debug("\nRECEIVED")
-            self.debug(f'{header} {body} {addr}')
+            self.debug(self.final_ack)
             self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
-            if header.ack == 1 and header.fin == 1:
-                self.update_state(States.FINACK_RECEIVED)
-                self.debug("Acknowledging FINACK (step 4)")
-                self.seq_num = header.ack_num
-                self.ack_num = header.seq_num + 1
-                ack_header = Header(
-                    seq_num=self.seq_num,
-                    ack_num=self.ack_num,
-                    ack=1,
-                )
-                self.debug("\nSENDING")
-                self.debug(ack_header)
-                self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
-                self.send_udp(ack_header.bits())
-                self.update_state(States.ACK_SENT)
-                self.update_state(States.TIME_WAIT)
-                self.time_wait()
+            self.send_header(self.final_ack)
+            self.update_state(States.ACK_SENT)
+            self.update_state(States.TIME_WAIT)
+            return True
+        return False
 
     def time_wait(self):
-        """ Currently in TIME WAIT state ; wait 2 * Max Segment Lifetime then close,
-        Assume Max Segment Lifetime is 5 seconds """
-        max_segment_lifetime = 5
-        wait_time = 2 * max_segment_lifetime
-        while wait_time > 0 :
-            self.debug(f'TIME_WAIT(remaining={wait_time}s)')
-            time.sleep(1)
-            wait_time -= 1
-        self.debug('Closing socket')
-        self.sock.close()
+        """ Currently in TIME WAIT state; keep the socket for 2 * Max Segment
+        Lifetime, acknowledging the server's FINACK again if it is repeated,
+        then close it. This happens on a daemon thread, so the caller can do
+        other work meanwhile; it must call wait_closed() before exiting """
+        deadline = time.time() + 2 * self.max_segment_lifetime
+        self.debug(f'TIME_WAIT({2 * self.max_segment_lifetime}s)')
+        self.linger_thread = threading.Thread(target=self.linger, args=(deadline,), daemon=True)
+        self.linger_thread.start()
+
+    def linger(self, deadline):
+        try:
+            while time.time() < deadline:
+                self.sock.settimeout(max(deadline - time.time(), 0.001))
+                try:
+                    header, body, addr = self.recv_msg()
+                except socket.timeout:
+                    break
+                self.absorb_late_segment(header)
+        finally:
+            self.debug('Closing socket')
+            self.sock.close()
+            self.closed.set()
+
+    def absorb_late_segment(self, header):
+        if header.fin == 1 and header.ack == 1:
+            self.debug('FINACK repeated, the final ACK was lost; sending it again')
+            self.send_header(self.final_ack)
+
+    def wait_closed(self, timeout=None):
+        """ Block until TIME_WAIT is over, if it was entered; False on timeout """
+        if self.linger_thread is None:
+            return True
+        return self.closed.wait(timeout)
 
     def update_state(self, new_state):
         self.debug(f'{self.client_state} -> {new_state}')
         self.client_state = new_state
 
-    def send_reliable_message(self, message):
+    def send_reliable_message(self, message, record_chunks=True):
+        """ Send message (str or bytes) over the established connection using
+        a sliding window (Go-Back-N or Selective Repeat, window_size 1 being
+        stop-and-wait); return the time each chunk took to be acknowledged """
+        return self.send_chunks(self.message_chunks(message), record_chunks)
+
+    def send_file(self, file, record_chunks=True):
+        """ Stream a file (a path or a binary file object) the same way; it is
+        read as the window opens, so memory use does not grow with its size.
+        For long transfers, pass record_chunks=False to not keep a record
+        for every chunk """
+        with self.open_file(file) as f:
+            return self.send_chunks(self.file_chunks(f), record_chunks)
+
+    def open_file(self, file):
+        """ Open a path for reading; a file object is used as is, and left
+        open for the caller to close """
+        if isinstance(file, (str, os.PathLike)):
+            return open(file, 'rb')
+        return contextlib.nullcontext(file)
+
+    def message_chunks(self, message):
+        """ Chunks of self.max_segment_size bytes; views of the encoded
+        message, not copies """
+        if isinstance(message, str):
+            message = str.encode(message)
+        message = memoryview(message)
+        return (message[i: i + self.max_segment_size] \
+                    for i in range(0, len(message), self.max_segment_size))
+
+    def file_chunks(self, f):
+        """ Chunks of up to self.max_segment_size bytes, read lazily from f """
+        while True:
+            chunk = f.read(self.max_segment_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def send_chunks(self, chunks, record_chunks=True):
+        """ Send chunks reliably; return the time each chunk took to be
+        acknowledged, if record_chunks """
         # For each chunk, save the time it takes to send and then receive acknowledgement
-        chunk_acknowledgement_times = []
-        # send messages
-        # we loop/wait until we receive all ack.
-        message_bytestring = str.encode(message)
-        # split message into chunks of self.max_segment_size bytes
-        chunks = [message_bytestring[i: i + self.max_segment_size] \
-                    for i in range(0, len(message_bytestring), self.max_segment_size)]
-        self.debug(f'Message "{message}" split into {len(chunks)} chunks')
-        for chunk in chunks:
-            header = Header(
-                seq_num=self.seq_num,
-                ack_num=self.ack_num,
-                psh=1
-            )
-            full_message = header.bits() + chunk
-            self.debug("\nSENDING (header and payload chunk)")
-            self.debug(header)
-            self.debug(chunk)
-            self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
-            successfully_sent_and_acknowledged = False
-            attempts = 0
-            start_time = time.time()
-            while not successfully_sent_and_acknowledged:
-                successfully_sent = False
-                while not successfully_sent:
-                    try:
-                        self.send_udp(full_message)
-                        successfully_sent = True
-                    except socket.timeout as e:
-                        # message drop
-                        self.info('timeout while sending message, resending segment')
+        chunk_acknowledgement_times = [] if record_chunks else None
+        window = self.new_window(chunks)
+        while not window.done():
+            if not self.send_window(window, time.time()):
+                self.sock.close()
+                self.server_alive = False
+                return
 
-                try:
-                    header, body, addr = self.recv_msg()
-                    if header.ack:
-                        # Only at this point has the message been
-                        # successfully sent AND acknowledged
-                        successfully_sent_and_acknowledged = True # exit outer while
-                        end_time = time.time()
-                        time_to_acknowledgement = end_time - start_time
-                        chunk_acknowledgement_times.append(
-                            {
-                                'chunk': chunk.decode(),
-                                'time_to_ack': time_to_acknowledgement,
-                                'channel_sleep_v': self.channel_sleep_v,
-                                'channel_sleep_factor': self.channel_sleep_factor,
-                                'channel_p_drop_server': self.channel_p_drop_server,
-                                'channel_p_drop_client': self.channel_p_drop_client,
-                            }
-                        )
-
-                except socket.timeout as e:
-                    self.info('timeout waiting for ACK, assume undelivered; restarting delivery for this chunk')
-                    attempts += 1
-                    if attempts >= 30: # 30 drops in a row very unlikely; server likely down
-                        self.debug('Server no longer responding, closing connection')
-                        self.sock.close()
-                        self.server_alive = False
-                        return
+            # block only until the next retransmission timer fires
+            self.sock.settimeout(self.time_until_retransmit(window))
+            try:
+                header, body, addr = self.recv_msg()
+            except socket.timeout:
+                continue
+            self.handle_ack(window, header, body, addr, chunk_acknowledgement_times)
+            # take in every ACK that has arrived meanwhile before sending
+            # again, so the segments they let in go out in one batch
+            for header, body, addr in self.recv_pending():
+                self.handle_ack(window, header, body, addr, chunk_acknowledgement_times)
 
+        self.sock.settimeout(self.timeout)
+        self.seq_num = window.next_seq
+        self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
+        return chunk_acknowledgement_times or []
+
+    def new_window(self, chunks):
+        """ Return the window that will send chunks; they are only pulled
+        from the iterable as the window opens """
+        self.debug(
+            f'Sending chunks of up to {self.max_segment_size} bytes '
+            f'with {self.transfer_mode} window of {self.window_size}')
+        # for the goodput of this transfer
+        self.transfer_started = time.time()
+        self.transfer_seq_num = self.seq_num
+        return SlidingWindow(
+            chunks,
+            seq_num=self.seq_num,
+            window_size=self.window_size,
+            mode=self.transfer_mode,
+            rto=self.rto,
+            congestion=self.congestion
+        )
+
+    def send_window(self, window, now):
+        """ Send segments that fit in the window and resend those whose timer
+        fired; return False if the server should be given up on """
+        expired = window.expired(now)
+        if any(s.transmissions > self.max_retransmits for s in expired):
+            self.debug(
+                f'Segment resent {self.max_retransmits} times without ACK; '
+                'server no longer responding, closing connection')
+            return False
+        for segment in expired:
+            self.info(f'timeout waiting for ACK of seq_num={segment.seq_num}, resending segment (RTO now {self.rto.rto:.3f}s)')
+        for segment in window.outstanding.values():
+            if segment.retransmit == 'fast':
+                self.info(f'{window.dup_acks} duplicate ACKs for seq_num={segment.seq_num}, fast retransmit')
+                if self.metrics is not None:
+                    # fast retransmits are never held back by cwnd, it goes out below
+                    self.metric_retransmits['fast'].inc()
+        segments = window.segments_to_send(now)
+        if self.metrics is not None:
+            self.metric_retransmits['timeout'].inc(len(expired))
+            self.metric_segments_sent.inc(len(segments))
+            self.metric_bytes_in_flight.set(window.bytes_in_flight())
+        self.send_datagrams([self.segment_datagram(s) for s in segments])
+        return True
+
+    def time_until_retransmit(self, window):
+        deadline = window.next_deadline() or time.time() + self.rto.rto
+        return max(deadline - time.time(), 0.001)
+
+    def handle_ack(self, window, header, body, addr, chunk_acknowledgement_times):
+        """ Slide the window on an ACK, recording the time each newly
+        acknowledged chunk took """
+        if self.verbose:
             self.debug("\nRECEIVED")
             self.debug(f'{header} {body} {addr}')
-            self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
-            if header.ack:
-                self.debug('PSH has been acknowledged')
-                self.seq_num = header.ack_num
-                self.ack_num = header.seq_num + 1
+        if not header.ack:
+            return
+        end_time = time.time()
+        dup_acks = window.dup_acks
+        acked = window.on_ack(header.ack_num, end_time, header.sack_blocks)
+        if self.metrics is not None:
+            self.record_ack_metrics(window, acked, end_time, window.dup_acks > dup_acks)
+        if acked and self.verbose:
+            self.debug(f'cwnd={self.congestion.cwnd} ssthresh={self.congestion.ssthresh}')
+        for segment in acked:
+            if self.verbose:
+                self.debug(f'PSH seq_num={segment.seq_num} has been acknowledged')
+            if chunk_acknowledgement_times is None and self.telemetry is None:
+                continue
+            record = {
+                'chunk': str(segment.payload, 'utf-8', 'replace'),
+                'time_to_ack': end_time - segment.first_sent,
+                'retransmits': segment.transmissions - 1,
+                'channel_sleep_v': self.channel_sleep_v,
+                'channel_sleep_factor': self.channel_sleep_factor,
+                'channel_p_drop_server': self.channel_p_drop_server,
+                'channel_p_drop_client': self.channel_p_drop_client,
+                # congestion window after this ACK
+                **self.congestion.snapshot(),
+            }
+            if chunk_acknowledgement_times is not None:
+                chunk_acknowledgement_times.append(record)
+            if self.telemetry is not None:
+                # a copy, as the exporter adds an _id
+                self.telemetry.submit(dict(record))
 
-        return chunk_acknowledgement_times
+    def record_ack_metrics(self, window, acked, now, duplicate):
+        if duplicate:
+            self.metric_dup_acks.inc()
+        if window.rtt_sample is not None:
+            self.metric_rtt.record(window.rtt_sample)
+        for segment in acked:
+            self.metric_bytes_acked.inc(len(segment.payload))
+            self.metric_chunk_latency.record(now - segment.first_sent)
+        if acked and now > self.transfer_started:
+            self.metric_goodput.set((window.last_ack - self.transfer_seq_num) / (now - self.transfer_started))
+        self.metric_bytes_in_flight.set(window.bytes_in_flight())
+
+    def segment_datagram(self, segment):
+        """ Header and payload of the PSH segment carrying a chunk of the message """
+        header = Header(
+            seq_num=segment.seq_num,
+            ack_num=self.ack_num,
+            psh=1
+        )
+        if self.verbose:
+            self.debug("\nSENDING (header and payload chunk)")
+            self.debug(header)
+            self.debug(segment.payload)
+        bits = header.bits()
+        if self.trace is not None:
+            self.trace.record(
+                RESEND if segment.transmissions > 1 else SEND,
+                header, len(bits) + len(segment.payload), self.server_addr[1])
+        return (bits, segment.payload)
 
     def dump_data_to_folder(self, folder_path, data):
         fname = f"{folder_path}/{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
         self.info(f"Dumping data to {fname}.csv")
         with open(f'{fname}','w') as f:
-            writer = csv.DictWriter(f, fieldnames=['time_to_ack', 'chunk', 'channel_sleep_v', 'channel_sleep_factor', 'channel_p_drop_server', 'channel_p_drop_client'])
+            writer = csv.DictWriter(f, fieldnames=['time_to_ack', 'retransmits', 'chunk', 'channel_sleep_v', 'channel_sleep_factor', 'channel_p_drop_server', 'channel_p_drop_client', 'congestion_control', 'cwnd', 'ssthresh'])
             writer.writeheader()
             writer.writerows(data)
 
-    def dump_data_to_couchdb(self, data_lst):
-        """ Dump a provided list of data to couchdb database using environment variables"""
+    def dump_data_to_store(self, path, data):
+        """ Append the records of this run to the results store at path """
+        # only needed to dump data; transfers work without numpy installed
+        from .results import ResultsStore
+        run_id = ResultsStore(path).append_run(data, name=datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+        self.info(f"Appended {len(data)} records to {path} as run {run_id}")
 
-        # Use environment for couchdb connection
-        self.couchdb_server = os.environ.get('COUCHDB_SERVER', 'localhost:5984')
-        self.couchdb_user = os.environ.get('COUCHDB_USER', 'admin')
-        self.couchdb_password = os.environ.get('COUCHDB_PASSWORD', '123456')
-        self.couchdb_database = os.environ.get('COUCHDB_DATABASE', 'database')
-        self.debug(
-            f"Using DB Info:"
-            f"SERVER:{self.couchdb_server}, "
-            f"USER: {self.couchdb_user}, "
-            f"Password: {self.couchdb_password}, "
-            f"DB: {self.couchdb_database}")
-        self.connect_couchdb()
-
-        try:
-            db = self.couch.create(self.couchdb_database)
-            self.debug(
-                f"Successfully created new CouchDB database {self.couchdb_database}")
-        except:
-            db = self.couch[self.couchdb_database]
-            self.debug(
-                f"Successfully connected to existing CouchDB database {self.couchdb_database}")
+    def dump_data_to_couchdb(self, data_lst):
+        """ Dump a provided list of data to couchdb database using environment
+        variables, in _bulk_docs batches; what cannot be saved is spooled to a
+        local file and saved by the next exporter that reaches the database.
+        To export during the transfer instead, pass a TelemetryExporter as telemetry """
+        from .telemetry import TelemetryExporter
+        telemetry = TelemetryExporter.from_environment(verbose=self.verbose).start()
         self.debug(f'Preparing to save {len(data_lst)} items to database')
-        fails = 0
         for item in data_lst:
-            try:
-                db.save(item)
-            except Exception as e:
-                self.error(e)
-                fails += 1
-        self.debug("Saving completed")
-        self.debug(f"Failed to save {fails} items")
+            telemetry.submit(dict(item))
+        telemetry.stop()
 
 if __name__ == "__main__":
 
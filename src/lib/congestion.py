@@ -0,0 +1,149 @@
+""" Congestion control for the sliding window sender. The window asks the
+algorithm how many bytes may be in flight (cwnd) and reports new ACKs,
+duplicate ACKs and timeouts to it; the algorithm does no I/O of its own """
+import math
+
+
+class CongestionControl:
+    """ No congestion control; only the window size limits what is in flight """
+    name = 'none'
+    fast_retransmit = False # resend the oldest segment after DUPTHRESH duplicate ACKs
+    DUPTHRESH = 3
+
+    def __init__(self, mss=12):
+        self.mss = mss
+        self.cwnd = math.inf # congestion window, bytes
+        self.ssthresh = math.inf # slow start threshold, bytes
+        self.in_recovery = False
+
+    def snapshot(self):
+        """ cwnd and ssthresh for records; None while unlimited """
+        return {
+            'congestion_control': self.name,
+            'cwnd': self.cwnd if math.isfinite(self.cwnd) else None,
+            'ssthresh': self.ssthresh if math.isfinite(self.ssthresh) else None,
+        }
+
+    def on_ack(self, acked_bytes, now, srtt=None):
+        """ An ACK advanced the left edge of the window """
+
+    def on_dup_ack(self):
+        """ A duplicate ACK arrived after the fast retransmit """
+
+    def on_fast_retransmit(self, flight, now):
+        """ DUPTHRESH duplicate ACKs; the oldest segment is being resent """
+
+    def on_timeout(self, flight, now):
+        """ The retransmission timer fired """
+
+
+class Reno(CongestionControl):
+    """ Slow start, additive increase / multiplicative decrease, fast
+    retransmit and fast recovery (RFC 5681) """
+    name = 'reno'
+    fast_retransmit = True
+
+    def __init__(self, mss=12):
+        super().__init__(mss)
+        # initial window (RFC 3390)
+        self.cwnd = min(4 * mss, max(2 * mss, 4380))
+
+    def loss_ssthresh(self, flight):
+        return max(flight / 2, 2 * self.mss)
+
+    def on_ack(self, acked_bytes, now, srtt=None):
+        if self.in_recovery:
+            # deflate the window inflated by the duplicate ACKs
+            self.in_recovery = False
+            self.cwnd = self.ssthresh
+        elif self.cwnd < self.ssthresh:
+            # slow start: doubling every RTT; counting the bytes acknowledged
+            # (up to 2 MSS per ACK, RFC 3465) so delayed ACKs do not slow it
+            self.cwnd += min(acked_bytes, 2 * self.mss)
+        else:
+            self.congestion_avoidance(acked_bytes, now, srtt)
+
+    def congestion_avoidance(self, acked_bytes, now, srtt):
+        # about one MSS per RTT
+        self.cwnd += self.mss * self.mss / self.cwnd
+
+    def on_dup_ack(self):
+        if self.in_recovery:
+            # another segment has left the network
+            self.cwnd += self.mss
+
+    def on_fast_retransmit(self, flight, now):
+        self.ssthresh = self.loss_ssthresh(flight)
+        self.cwnd = self.ssthresh + self.DUPTHRESH * self.mss
+        self.in_recovery = True
+
+    def on_timeout(self, flight, now):
+        self.ssthresh = self.loss_ssthresh(flight)
+        self.cwnd = self.mss # loss window
+        self.in_recovery = False
+
+
+class Cubic(Reno):
+    """ CUBIC (RFC 9438): after a loss the window grows along a cubic curve
+    centred on the window the loss happened at, so it returns there quickly,
+    probes carefully around it and only then speeds up. The growth depends
+    on the time since the loss rather than on the RTT. Slow start and fast
+    recovery are those of Reno """
+    name = 'cubic'
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, mss=12):
+        super().__init__(mss)
+        self.w_max = 0 # window (segments) before the last reduction
+        self.epoch_start = None
+        self.k = 0
+        self.origin = 0
+        self.w_est = 0 # what Reno would have reached; CUBIC never grows slower
+
+    def on_congestion(self, now):
+        cwnd = self.cwnd / self.mss
+        if cwnd < self.w_max:
+            # fast convergence: still below the last maximum, so the path is
+            # shared; give up more bandwidth to newer flows
+            self.w_max = cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_max = cwnd
+        self.ssthresh = max(self.cwnd * self.BETA, 2 * self.mss)
+        self.epoch_start = None
+
+    def congestion_avoidance(self, acked_bytes, now, srtt):
+        cwnd = self.cwnd / self.mss
+        if self.epoch_start is None:
+            self.epoch_start = now
+            if cwnd < self.w_max:
+                self.k = ((self.w_max - cwnd) / self.C) ** (1 / 3)
+                self.origin = self.w_max
+            else:
+                self.k = 0
+                self.origin = cwnd
+            self.w_est = cwnd
+        t = now - self.epoch_start + (srtt or 0)
+        target = self.origin + self.C * (t - self.k) ** 3
+        target = min(max(target, cwnd), 1.5 * cwnd)
+        self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) * (acked_bytes / self.mss) / cwnd
+        if self.w_est > target:
+            target = self.w_est
+        self.cwnd += self.mss * (target - cwnd) / cwnd
+
+    def on_fast_retransmit(self, flight, now):
+        self.on_congestion(now)
+        self.cwnd = self.ssthresh + self.DUPTHRESH * self.mss
+        self.in_recovery = True
+
+    def on_timeout(self, flight, now):
+        self.on_congestion(now)
+        self.cwnd = self.mss
+        self.in_recovery = False
+
+
+CONGESTION_CONTROLS = {
+    'none': CongestionControl,
+    'reno': Reno,
+    'cubic': Cubic,
+}
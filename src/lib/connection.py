@@ -0,0 +1,245 @@
+""" Server side state machine of a single client connection. A connection
+does no socket I/O itself: it is fed the datagrams received from its peer and
+replies through a send callback, so one server socket (or transport) can
+serve any number of connections """
+from .utils import *
+from .reassembly import ReassemblyBuffer
+from .trace import SEND
+
+# Assume Max Segment Lifetime is 5 seconds
+MAX_SEGMENT_LIFETIME = 5
+
+
+class ServerConnection:
+    def __init__(self, addr, send, sink_factory, window_size=64, max_segment_size=1400,
+        ack_every=1, ack_delay=0.04, call_later=None, time_wait=2 * MAX_SEGMENT_LIFETIME,
+        on_closed=None, trace=None, metrics=None, log=None):
+        """ addr: peer address; send(data): send a datagram to the peer;
+        sink_factory(addr): open the sink received data is delivered to;
+        max_segment_size: largest payload this side accepts, advertised in the SYN-ACK;
+        ack_every, ack_delay: delayed ACKs, see handle_established;
+        call_later(delay, callback): timer of the event loop the connection runs on,
+        returning a handle with cancel(); required if ack_every > 1 or on_closed is given;
+        time_wait: seconds the terminated connection lingers to absorb late segments;
+        on_closed(connection): called once that is over, or time_wait after the
+        FIN-ACK if the final ACK never arrives;
+        trace: PacketTrace the segments sent are recorded in, or None;
+        metrics: MetricsRegistry for the connection's counters, or None;
+        log: object with debug/info/error methods (e.g. the Server) """
+        self.addr = addr
+        self.send = send
+        self.sink_factory = sink_factory
+        self.window_size = window_size # max out of order segments held for reassembly
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.call_later = call_later
+        self.time_wait = time_wait
+        self.on_closed = on_closed
+        self.close_timer = None
+        self.fin_ack = None # resent if the peer repeats its FIN
+        self.unacked = 0 # in order segments received since the last ACK
+        self.ack_timer = None
+        self.log = log
+        self.trace = trace
+        self.metrics = metrics
+        if metrics is not None:
+            self.setup_metrics(metrics)
+        # per segment debug messages are only formatted if the log shows them
+        self.verbose = log is not None and getattr(log, 'verbose', True)
+        self.state = States.LISTEN
+        self.seq_num = None
+        self.ack_num = None
+        self.local_max_segment_size = max_segment_size
+        self.max_segment_size = None # negotiated in the handshake
+        self.reassembly = None
+        self.sink = None
+        self.last_received_seq_num = None
+
+    def setup_metrics(self, metrics):
+        # the counters are shared by all connections: labelled by peer, every
+        # client address would add series to the registry for good
+        self.metric_segments = metrics.counter(
+            'server_segments_received_total', 'PSH segments received')
+        self.metric_duplicates = metrics.counter(
+            'server_duplicate_segments_total', 'PSH segments entirely received before')
+        self.metric_out_of_order = metrics.counter(
+            'server_out_of_order_segments_total', 'PSH segments received beyond a gap')
+        self.metric_bytes_delivered = metrics.counter(
+            'server_bytes_delivered_total', 'payload bytes delivered in order to the sink')
+        self.metric_acks = metrics.counter(
+            'server_acks_sent_total', 'ACKs sent for PSH segments')
+
+    def debug(self, msg):
+        if self.log is not None:
+            self.log.debug(f'[{self.addr[0]}:{self.addr[1]}] {msg}')
+
+    def update_state(self, new_state):
+        self.debug(f'{self.state} -> {new_state}')
+        self.state = new_state
+
+    def send_header(self, header):
+        if self.verbose:
+            self.debug("\nSENDING")
+            self.debug(header)
+            self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
+        data = header.bits()
+        if self.trace is not None:
+            self.trace.record(SEND, header, len(data), self.addr[1])
+        self.send(data)
+
+    def handle(self, header, body):
+        """ Take action on a datagram from the peer based on the current state
+        and update the state accordingly """
+        if self.verbose:
+            self.debug("\nRECEIVED")
+            self.debug(f'{header} {body}')
+        if self.state == States.LISTEN:
+            if header.syn == 1:
+                self.handle_syn(header)
+
+        elif self.state == States.SYNACK_SENT:
+            if header.ack == 1:
+                self.update_state(States.ACK_RECEIVED)
+                self.update_state(States.ESTABLISHED)
+            elif header.psh == 1:
+                # the handshake ACK was overtaken by data; data implies it
+                self.update_state(States.ESTABLISHED)
+                self.handle_established(header, body)
+
+        elif self.state == States.ESTABLISHED:
+            self.handle_established(header, body)
+
+        elif self.state == States.FINACK_SENT:
+            if header.fin == 1:
+                self.debug('FIN repeated, the FIN-ACK was lost; sending it again')
+                self.send_header(self.fin_ack)
+                return
+            self.seq_num = header.ack_num
+            self.ack_num = header.seq_num + 1
+            self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
+            if header.ack == 1:
+                self.update_state(States.ACK_RECEIVED)
+                self.debug('Completed 3-way termination')
+                self.update_state(States.TIME_WAIT)
+                # the peer is forgotten once TIME_WAIT is over
+                self.close_later(self.time_wait)
+            self.last_received_seq_num = header.seq_num
+
+        elif self.state == States.TIME_WAIT:
+            if header.fin == 1:
+                self.send_header(self.fin_ack)
+            self.debug('Connection in TIME_WAIT, absorbing late segment')
+
+    def handle_syn(self, header):
+        self.debug('SYN received, new handshake started by client')
+        self.update_state(States.SYN_RECEIVED)
+        self.seq_num = rand_int()
+        self.ack_num = header.seq_num + 1
+        # the segments of either side must fit the other's buffers
+        self.max_segment_size = min(header.mss, self.local_max_segment_size)
+        self.debug(f'Client MSS {header.mss}, using {self.max_segment_size}')
+        self.reassembly = ReassemblyBuffer(self.ack_num, capacity=self.window_size)
+        self.sink = self.sink_factory(self.addr)
+        self.send_header(Header(
+            seq_num=self.seq_num,
+            ack_num=self.ack_num,
+            syn=1,
+            ack=1,
+            mss=self.local_max_segment_size
+        ))
+        self.update_state(States.SYNACK_SENT)
+        self.last_received_seq_num = header.seq_num
+
+    def handle_established(self, header, body):
+        """ Listen for normal messages AND for FIN messages """
+        if self.verbose:
+            self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
+        if header.fin == 1:
+            self.update_state(States.FIN_RECEIVED)
+            self.close()
+            self.seq_num = header.ack_num
+            self.ack_num = header.seq_num + 1
+            self.fin_ack = Header(
+                seq_num=self.seq_num,
+                ack_num=self.ack_num,
+                ack=1,
+                fin=1
+            )
+            self.send_header(self.fin_ack)
+            self.update_state(States.FINACK_SENT)
+            # not left open forever should the final ACK be lost
+            self.close_later(self.time_wait)
+
+        elif header.psh == 1:
+            in_order = header.seq_num == self.reassembly.rcv_nxt
+            if self.verbose:
+                self.debug(f'Payload Length: {len(body)}')
+                if header.seq_num < self.reassembly.rcv_nxt:
+                    self.debug(f'Duplicate! seq_num {header.seq_num} already received')
+                elif header.seq_num > self.reassembly.rcv_nxt:
+                    self.debug(f'Out of order seq_num {header.seq_num}, expected {self.reassembly.rcv_nxt}')
+            if self.metrics is not None:
+                self.metric_segments.inc()
+                if header.seq_num + len(body) <= self.reassembly.rcv_nxt:
+                    self.metric_duplicates.inc()
+                elif header.seq_num > self.reassembly.rcv_nxt:
+                    self.metric_out_of_order.inc()
+            for seq_num, data in self.reassembly.add(header.seq_num, body):
+                self.sink.write(seq_num, data)
+                if self.metrics is not None:
+                    self.metric_bytes_delivered.inc(len(data))
+            self.ack_num = self.reassembly.rcv_nxt
+            self.seq_num = header.ack_num
+            # Delayed ACKs (RFC 1122, 5681): an in order segment is only
+            # acknowledged with every ack_every-th one, or after ack_delay.
+            # Anything out of order, a duplicate, or a segment while a gap
+            # remains is acknowledged at once, so the client sees duplicate
+            # ACKs / SACKs without delay
+            self.unacked += 1
+            if not in_order or len(self.reassembly) or self.unacked >= self.ack_every:
+                self.send_ack()
+            elif self.ack_timer is None:
+                self.ack_timer = self.call_later(self.ack_delay, self.send_ack)
+        self.last_received_seq_num = header.seq_num
+
+    def send_ack(self):
+        """ Acknowledge cumulatively, and advertise what is held beyond the
+        first gap so the client only resends the holes """
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        self.unacked = 0
+        if self.metrics is not None:
+            self.metric_acks.inc()
+        self.send_header(Header(
+            seq_num=self.seq_num,
+            ack_num=self.ack_num,
+            ack=1,
+            sack_blocks=self.reassembly.sack_blocks()
+        ))
+
+    def close_later(self, delay):
+        """ (Re)start the timer after which on_closed is called """
+        if self.on_closed is None:
+            return
+        if self.close_timer is not None:
+            self.close_timer.cancel()
+        self.close_timer = self.call_later(delay, self.closed)
+
+    def closed(self):
+        self.close_timer = None
+        self.debug(f'{self.state} over')
+        self.on_closed(self)
+
+    def close(self):
+        """ Close the sink (all data has been received) and stop the timers """
+        if self.close_timer is not None:
+            self.close_timer.cancel()
+            self.close_timer = None
+        if self.ack_timer is not None:
+            # the FIN-ACK acknowledges everything
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
@@ -0,0 +1,51 @@
+""" Vectorized group-by statistics over columnar NumPy arrays, used by the
+aggregator to summarize time_to_ack per combination of channel parameters
+without starting Spark """
+import numpy as np
+
+PERCENTILES = (50, 90, 99)
+
+
+def to_columns(rows, width):
+    """ (keys, values) arrays from (key tuple, value) pairs: keys is an
+    (n, width) float64 array, values a float64 array of n """
+    keys, values = [], []
+    for key, value in rows:
+        keys.append(key)
+        values.append(value)
+    return (
+        np.array(keys, dtype=np.float64).reshape(len(keys), width),
+        np.array(values, dtype=np.float64))
+
+
+def group_stats(keys, values, percentiles=PERCENTILES):
+    """ count, mean, stddev (sample), the given percentiles (linear
+    interpolation, as numpy.percentile) and max of values for each distinct
+    row of keys. Rows are sorted by key and then value, so each group is a
+    contiguous, ordered slice: sums come from np.add.reduceat over the
+    group starts and percentiles are read off by position. Returns the
+    distinct keys in sorted order and a dict of arrays aligned with them """
+    if len(values) == 0:
+        empty = np.empty(0)
+        stats = {'count': np.empty(0, dtype=np.int64), 'mean': empty, 'stddev': empty, 'max': empty}
+        stats.update((f'p{p}', empty) for p in percentiles)
+        return keys[:0], stats
+    # np.lexsort sorts by its last key first
+    order = np.lexsort((values,) + tuple(keys[:, i] for i in reversed(range(keys.shape[1]))))
+    keys, values = keys[order], values[order]
+    new_group = np.ones(len(values), dtype=bool)
+    new_group[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+    starts = np.flatnonzero(new_group)
+    counts = np.diff(np.append(starts, len(values)))
+    means = np.add.reduceat(values, starts) / counts
+    deviations = values - np.repeat(means, counts)
+    m2 = np.add.reduceat(deviations * deviations, starts)
+    stddev = np.sqrt(np.divide(m2, counts - 1, out=np.zeros_like(m2), where=counts > 1))
+    stats = {'count': counts, 'mean': means, 'stddev': stddev}
+    for p in percentiles:
+        position = starts + (counts - 1) * (p / 100)
+        below = np.floor(position).astype(np.int64)
+        above = np.ceil(position).astype(np.int64)
+        stats[f'p{p}'] = values[below] + (values[above] - values[below]) * (position - below)
+    stats['max'] = values[starts + counts - 1]
+    return keys[starts], stats
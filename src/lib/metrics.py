@@ -0,0 +1,261 @@
+""" Live metrics shared by the client, server and channel: counters, gauges
+and latency histograms kept in a registry, which can be scraped over HTTP in
+the Prometheus text format and/or written to a JSON snapshot file
+periodically, so long runs can be watched while they happen. Recording is a
+few integer operations; all formatting happens in the exporter thread """
+import http.server
+import json
+import math
+import os
+import threading
+import time
+
+
+class Counter:
+    """ A value that only goes up """
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """ A value that goes up and down; with fn, the value is read from
+    fn() whenever the gauge is exported """
+    kind = 'gauge'
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.fn() if self.fn is not None else self.value
+
+
+class Histogram:
+    """ Latency histogram in the style of HdrHistogram: values are counted
+    in units of `unit` seconds, exactly below 2**sub_bucket_bits units and
+    in log-linear buckets above, so every recorded value is kept to within
+    1 / 2**(sub_bucket_bits - 1) of its true value whatever its magnitude,
+    in a few hundred counters at most """
+    kind = 'summary'
+    QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+    def __init__(self, unit=1e-6, sub_bucket_bits=5):
+        self.unit = unit
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.half_count = self.sub_bucket_count >> 1
+        self.counts = [0] * self.sub_bucket_count
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def index(self, units):
+        if units < self.sub_bucket_count:
+            return units
+        shift = units.bit_length() - self.sub_bucket_bits
+        return shift * self.half_count + (units >> shift)
+
+    def bucket_upper(self, index):
+        """ Largest value, in seconds, counted in bucket index """
+        if index < self.sub_bucket_count:
+            return (index + 1) * self.unit
+        shift = index // self.half_count - 1
+        return ((index - shift * self.half_count + 1) << shift) * self.unit
+
+    def record(self, value):
+        """ Record a value in seconds """
+        i = self.index(max(int(value / self.unit), 0))
+        if i >= len(self.counts):
+            self.counts.extend([0] * (i + 1 - len(self.counts)))
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """ Value below which a fraction q of the recorded values fall """
+        if not self.count:
+            return None
+        rank = max(math.ceil(q * self.count), 1)
+        seen = 0
+        for i, count in enumerate(list(self.counts)):
+            seen += count
+            if seen >= rank:
+                return min(self.bucket_upper(i), self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            **{f'p{round(q * 100)}': self.quantile(q) for q in self.QUANTILES},
+        }
+
+
+class MetricsRegistry:
+    """ Metrics by name and labels. A metric is created on first use and
+    then kept by the caller, so recording does not look it up again """
+    def __init__(self, prefix='tcpudp_'):
+        self.prefix = prefix
+        self.metrics = {} # (name, labels) -> metric
+        self.help = {} # name -> help text
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def get(self, cls, name, help, labels, **kwargs):
+        name = self.prefix + name
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = cls(**kwargs)
+                self.help.setdefault(name, help)
+        return metric
+
+    def counter(self, name, help='', **labels):
+        return self.get(Counter, name, help, labels)
+
+    def gauge(self, name, help='', fn=None, **labels):
+        return self.get(Gauge, name, help, labels, fn=fn)
+
+    def histogram(self, name, help='', unit=1e-6, **labels):
+        return self.get(Histogram, name, help, labels, unit=unit)
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format """
+        with self.lock:
+            metrics = sorted(self.metrics.items(), key=lambda item: item[0])
+        lines = []
+        last_name = None
+        for (name, labels), metric in metrics:
+            if name != last_name:
+                lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} {metric.kind}')
+                last_name = name
+            if isinstance(metric, Histogram):
+                for q in metric.QUANTILES:
+                    value = metric.quantile(q)
+                    lines.append(f'{name}{format_labels(labels + (("quantile", str(q)),))} '
+                        f'{format_value(value if value is not None else math.nan)}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(metric.sum)}')
+                lines.append(f'{name}_count{format_labels(labels)} {metric.count}')
+            else:
+                lines.append(f'{name}{format_labels(labels)} {format_value(metric.snapshot())}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """ All metrics as a JSON serializable dict """
+        with self.lock:
+            metrics = sorted(self.metrics.items(), key=lambda item: item[0])
+        return {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'metrics': [
+                {'name': name, 'labels': dict(labels), 'type': metric.kind, 'value': metric.snapshot()}
+                for (name, labels), metric in metrics],
+        }
+
+    def write_snapshot(self, path):
+        """ Replace path with a snapshot; readers never see a partial file """
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp, path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+class MetricsExporter:
+    """ Serves a registry at http://host:port/metrics (Prometheus) and
+    /snapshot (JSON), and/or writes it to a snapshot file every interval
+    seconds, from daemon threads so the protocol loop is not held up """
+    def __init__(self, registry, port=None, path=None, interval=5.0, host='127.0.0.1'):
+        self.registry = registry
+        self.port = port
+        self.path = path
+        self.interval = interval
+        self.host = host
+        self.httpd = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.port is not None:
+            self.httpd = http.server.ThreadingHTTPServer(
+                (self.host, self.port), self.handler_class())
+            self.port = self.httpd.server_address[1] # the actual port if 0 was given
+            threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        if self.path is not None:
+            threading.Thread(target=self.write_periodically, daemon=True).start()
+        return self
+
+    def handler_class(self):
+        registry = self.registry
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path in ('/', '/metrics'):
+                    body = registry.render().encode()
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif self.path == '/snapshot':
+                    body = json.dumps(registry.snapshot()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # scrapes would flood the component's output
+
+        return MetricsHandler
+
+    def write_periodically(self):
+        while not self.stopped.wait(self.interval):
+            self.registry.write_snapshot(self.path)
+
+    def stop(self):
+        """ Stop serving; the snapshot file gets the final values """
+        self.stopped.set()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        if self.path is not None:
+            self.registry.write_snapshot(self.path)
@@ -0,0 +1,78 @@
+""" Receive side reassembly of segments that arrive out of order """
+import bisect
+
+
+class ReassemblyBuffer:
+    def __init__(self, rcv_nxt, capacity=64):
+        """ rcv_nxt is the seq num of the next byte expected in order;
+        capacity is the max number of out of order segments held """
+        self.rcv_nxt = rcv_nxt
+        self.capacity = capacity
+        self.segments = {} # seq_num -> body, all beyond rcv_nxt
+        self.offsets = [] # sorted keys of self.segments
+        self.last_received = None # seq_num of the latest out of order arrival
+
+    def __len__(self):
+        return len(self.segments)
+
+    def add(self, seq_num, body):
+        """ Add a received segment; return the list of (seq_num, body) that are
+        now contiguous with what has been delivered, in order. Duplicate and
+        overlapping bytes are trimmed so each byte is delivered exactly once.
+        body may be a memoryview of a reused receive buffer: it is only
+        copied if it has to be held """
+        end = seq_num + len(body)
+        if end <= self.rcv_nxt:
+            return [] # entirely a duplicate
+        if seq_num < self.rcv_nxt:
+            # retransmission overlapping data already delivered
+            body = body[self.rcv_nxt - seq_num:]
+            seq_num = self.rcv_nxt
+        if seq_num > self.rcv_nxt:
+            self.hold(seq_num, body)
+            return []
+
+        delivered = [(seq_num, body)]
+        self.rcv_nxt = end
+        # drain held segments that are now in order
+        while self.offsets and self.offsets[0] <= self.rcv_nxt:
+            held_seq = self.offsets.pop(0)
+            held = self.segments.pop(held_seq)
+            held_end = held_seq + len(held)
+            if held_end > self.rcv_nxt:
+                delivered.append((self.rcv_nxt, held[self.rcv_nxt - held_seq:]))
+                self.rcv_nxt = held_end
+        return delivered
+
+    def hold(self, seq_num, body):
+        """ Keep an out of order segment until the gap before it is filled """
+        self.last_received = seq_num
+        held = self.segments.get(seq_num)
+        if held is not None:
+            if len(body) > len(held):
+                self.segments[seq_num] = bytes(body)
+            return
+        if len(self.segments) >= self.capacity:
+            self.last_received = None
+            return
+        bisect.insort(self.offsets, seq_num)
+        self.segments[seq_num] = bytes(body)
+
+    def sack_blocks(self, max_blocks=4):
+        """ Contiguous (left, right) ranges held beyond rcv_nxt. As in RFC 2018
+        the block containing the most recent arrival is listed first, the rest
+        follow in seq num order """
+        blocks = []
+        for seq_num in self.offsets:
+            end = seq_num + len(self.segments[seq_num])
+            if blocks and seq_num <= blocks[-1][1]:
+                blocks[-1][1] = max(blocks[-1][1], end)
+            else:
+                blocks.append([seq_num, end])
+        blocks = [tuple(block) for block in blocks]
+        if self.last_received is not None:
+            for i, (left, right) in enumerate(blocks):
+                if left <= self.last_received < right:
+                    blocks.insert(0, blocks.pop(i))
+                    break
+        return blocks[:max_blocks]
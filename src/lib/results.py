@@ -0,0 +1,192 @@
+""" Columnar store of the client's per-chunk measurements. A store is a
+folder holding one raw little-endian file per column, appended to run after
+run, and a small JSON index: the distinct channel-parameter tuples (a row
+only keeps the id of its tuple), the runs, and the number of complete rows.
+Queries memory-map the columns, so millions of rows are read without
+parsing anything:
+
+    python -m lib.results STORE --import_csv data/*.csv
+    python -m lib.results STORE --summary
+"""
+import argparse
+import contextlib
+import csv
+import json
+import os
+import numpy as np
+from .utils import GROUP_FIELDS
+from .grouping import PERCENTILES, group_stats
+try:
+    import fcntl
+except ImportError: # Windows: concurrent writers are then not serialized
+    fcntl = None
+
+COLUMNS = {
+    'time_to_ack': np.dtype('<f8'),
+    'param_id': np.dtype('<u4'), # position of the channel parameters in the index
+    'run_id': np.dtype('<u4'),
+    'retransmits': np.dtype('<u2'),
+}
+INDEX_FILE = 'index.json'
+LOCK_FILE = 'lock'
+
+
+class ResultsStore:
+    """ Append-only store at path (created if missing). Appends are written
+    to the columns first and only counted once the index is replaced, so a
+    writer that dies midway leaves the store as it was before the append """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.load_index()
+
+    def load_index(self):
+        try:
+            with open(os.path.join(self.path, INDEX_FILE)) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {'rows': 0, 'params': [], 'runs': []}
+        self.param_ids = {tuple(params): i for i, params in enumerate(self.index['params'])}
+
+    def write_index(self):
+        tmp = os.path.join(self.path, INDEX_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, os.path.join(self.path, INDEX_FILE))
+
+    def __len__(self):
+        return self.index['rows']
+
+    @property
+    def runs(self):
+        """ name, first row and row count of each run, by run id """
+        return self.index['runs']
+
+    def param_id(self, params):
+        """ Id of a channel-parameter tuple, added to the index if new """
+        params = tuple(float(value) for value in params)
+        if params not in self.param_ids:
+            self.param_ids[params] = len(self.index['params'])
+            self.index['params'].append(list(params))
+        return self.param_ids[params]
+
+    def append_run(self, records, name=None):
+        """ Append the records of one run (dicts with time_to_ack, the
+        channel_* parameters and optionally retransmits); return its run id """
+        with self.locked():
+            self.load_index()
+            rows = self.index['rows']
+            columns = {column: [] for column in COLUMNS}
+            for record in records:
+                columns['time_to_ack'].append(float(record['time_to_ack']))
+                columns['param_id'].append(self.param_id(record[field] for field in GROUP_FIELDS))
+                columns['retransmits'].append(min(int(float(record.get('retransmits') or 0)), 0xffff))
+            count = len(columns['time_to_ack'])
+            run_id = len(self.index['runs'])
+            columns['run_id'] = [run_id] * count
+            for column, dtype in COLUMNS.items():
+                with open(self.column_path(column), 'ab') as f:
+                    # drop what an interrupted append left past the last complete row
+                    f.truncate(rows * dtype.itemsize)
+                    f.write(np.array(columns[column], dtype=dtype).tobytes())
+            self.index['runs'].append({'name': name or f'run-{run_id}', 'start': rows, 'rows': count})
+            self.index['rows'] = rows + count
+            self.write_index()
+        return run_id
+
+    @contextlib.contextmanager
+    def locked(self):
+        """ Hold the store's lock file, so concurrent clients append one
+        after the other """
+        with open(os.path.join(self.path, LOCK_FILE), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield # closing the file releases the lock
+
+    def column_path(self, column):
+        return os.path.join(self.path, f'{column}.bin')
+
+    def column(self, column):
+        """ The complete rows of a column, memory-mapped read-only """
+        rows = self.index['rows']
+        if rows == 0:
+            return np.empty(0, dtype=COLUMNS[column])
+        return np.memmap(self.column_path(column), dtype=COLUMNS[column], mode='r', shape=(rows,))
+
+    def params(self):
+        """ (number of parameter tuples, 4) array; row i is param_id i """
+        return np.array(self.index['params'], dtype=np.float64).reshape(-1, len(GROUP_FIELDS))
+
+    def select(self, p_drop_server, p_drop_client, sleep_v, sleep_factor):
+        """ Row numbers measured with the given channel parameters """
+        params = (float(p_drop_server), float(p_drop_client), float(sleep_v), float(sleep_factor))
+        if params not in self.param_ids:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(self.column('param_id') == self.param_ids[params])
+
+    def group_stats(self, percentiles=PERCENTILES):
+        """ Statistics of time_to_ack per channel-parameter tuple, as
+        grouping.group_stats, with the mean retransmits of each group """
+        param_ids = self.column('param_id')
+        keys, stats = group_stats(param_ids.reshape(-1, 1), self.column('time_to_ack'), percentiles)
+        ids = keys[:, 0].astype(np.int64)
+        retransmits = np.bincount(param_ids, weights=self.column('retransmits'), minlength=len(self.index['params']))
+        stats['retransmits'] = retransmits[ids] / stats['count']
+        return self.params()[ids], stats
+
+    def import_csv(self, path):
+        """ Append a CSV written by Client.dump_data_to_folder as a run named
+        after the file; files without a retransmits column count 0 """
+        with open(path, newline='') as f:
+            return self.append_run(csv.DictReader(f), name=os.path.basename(path))
+
+    def import_couchdb(self, db, page_size=1000, name=None):
+        """ Append the time_to_ack documents of a couchdb database (a
+        couchdb.Database), read page_size at a time, as one run """
+        records = (
+            row.doc for row in db.iterview('_all_docs', page_size, include_docs=True)
+            if row.doc.get('time_to_ack') is not None and all(field in row.doc for field in GROUP_FIELDS))
+        return self.append_run(records, name=name or db.name)
+
+
+def format_summary(store):
+    keys, stats = store.group_stats()
+    lines = [' '.join(f'{title:>10}' for title in (
+        'p_drop_srv', 'p_drop_cli', 'sleep_v', 'sleep_f', 'count', 'mean', 'stddev',
+        *(f'p{p}' for p in PERCENTILES), 'max', 'retrans'))]
+    for i, key in enumerate(keys):
+        lines.append(' '.join(f'{value:>10g}' for value in (
+            *key, stats['count'][i], stats['mean'][i], stats['stddev'][i],
+            *(stats[f'p{p}'][i] for p in PERCENTILES), stats['max'][i], stats['retransmits'][i])))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('import into and summarize a results store')
+    parser.add_argument('store', help='folder of the store; created if missing')
+    parser.add_argument('-csv', '--import_csv', nargs='+', default=[], help=(
+        'CSV files written with --dump_folder, each appended as a run'
+    ))
+    parser.add_argument('-cdb', '--import_couchdb', action='store_true', help=(
+        'append the records of the couchdb database given by the COUCHDB_* environment '
+        'variables as a run'
+    ))
+    parser.add_argument('-s', '--summary', action='store_true', help=(
+        'print count, mean, stddev, percentiles and max of time_to_ack and the mean '
+        'retransmits per combination of channel parameters'
+    ))
+    args = parser.parse_args()
+
+    store = ResultsStore(args.store)
+    for path in args.import_csv:
+        run_id = store.import_csv(path)
+        print(f'{path}: run {run_id}, {store.runs[run_id]["rows"]} rows')
+    if args.import_couchdb:
+        import couchdb
+        server = couchdb.Server(
+            f"http://{os.environ.get('COUCHDB_USER', 'admin')}:{os.environ.get('COUCHDB_PASSWORD', '123456')}"
+            f"@{os.environ.get('COUCHDB_SERVER', 'localhost:5984')}/")
+        run_id = store.import_couchdb(server[os.environ.get('COUCHDB_DATABASE', 'database')])
+        print(f'couchdb: run {run_id}, {store.runs[run_id]["rows"]} rows')
+    if args.summary:
+        print(format_summary(store))
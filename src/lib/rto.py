@@ -0,0 +1,53 @@
+""" Retransmission timeout estimation (RFC 6298) """
+
+
+class RTOEstimator:
+    """ Keeps a smoothed RTT (SRTT) and RTT variation (RTTVAR) from RTT samples
+    and derives the retransmission timeout from them. Callers are expected to
+    follow Karn's rule and only sample segments that were sent exactly once """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, initial_rto=1.0, min_rto=0.2, max_rto=10.0, granularity=0.001):
+        # RFC 6298 recommends a 1s floor; on a lab channel with 50-200ms delays
+        # that floor would dominate, so the floor is configurable (Linux uses 200ms)
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.granularity = granularity # clock granularity G
+        self.srtt = None
+        self.rttvar = None
+        self.backoffs = 0 # consecutive timeouts since the last new ACK
+        self.rto = self._bound(initial_rto)
+
+    def _bound(self, rto):
+        return min(max(rto, self.min_rto), self.max_rto)
+
+    def _base_rto(self):
+        if self.srtt is None:
+            return self.initial_rto
+        return self.srtt + max(self.granularity, self.K * self.rttvar)
+
+    def sample(self, rtt):
+        """ Update SRTT/RTTVAR with a new RTT measurement (seconds) """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.backoffs = 0
+        self.rto = self._bound(self._base_rto())
+
+    def backoff(self):
+        """ Retransmission timer expired; double the RTO """
+        self.backoffs += 1
+        self.rto = self._bound(self.rto * 2)
+
+    def reset_backoff(self):
+        """ New data was acknowledged; as Linux does, drop the exponential
+        backoff without waiting for a valid RTT sample """
+        if self.backoffs:
+            self.backoffs = 0
+            self.rto = self._bound(self._base_rto())
@@ -1,16 +1,59 @@
 import socket
 from .utils import *
-import time
+from .connection import ServerConnection, MAX_SEGMENT_LIFETIME
+from .sink import FileSink, SegmentFileSink, TeeSink
+from .batchio import DatagramBatch
+from .timers import TimerQueue
+from .trace import RECV
+import os
+import threading
 import logging
 
 class Server:
-    def __init__(self, time_wait_on_terminate=30, verbose=False):
+    def __init__(self, time_wait_on_terminate=None, window_size=64, max_segment_size=1400,
+        ack_every=1, ack_delay=0.04, max_segment_lifetime=MAX_SEGMENT_LIFETIME,
+        output_file='./server/received-full-msg-{host}_{port}.txt', segment_files=False,
+        fsync=False, preallocate=0, sink_factory=None, batch_io=True, trace=None, metrics=None,
+        verbose=False):
         self.setup_logging(verbose=verbose)
         self.server_state = States.CLOSED
         self.sock = None
-        self.time_wait_on_terminate = time_wait_on_terminate
-        self.last_received_seq_num = None
-        self.message_buffer = []
+        self.udp_port = None
+        # used to stop serving if needed (from another thread, etc.)
+        self.event_terminate = threading.Event()
+        # seconds a terminated connection lingers to absorb late segments of
+        # its client (2 * MSL by default); each has its own timer, and the
+        # socket keeps serving every other client meanwhile
+        self.time_wait_on_terminate = 2 * max_segment_lifetime if time_wait_on_terminate is None \
+            else time_wait_on_terminate
+        self.window_size = window_size # max out of order segments held for reassembly, per connection
+        # largest payload accepted, advertised to every client; clients may negotiate less
+        self.max_segment_size = max_segment_size
+        # delayed ACKs: acknowledge every ack_every-th in order segment, or
+        # ack_delay seconds after an unacknowledged one (1: ACK every segment)
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        self.timers = TimerQueue()
+        # the first datagram of each wake-up is received into this one buffer, see serve
+        self.recv_buffer = bytearray(MAX_HEADER_SIZE + max_segment_size)
+        # datagrams that queued up meanwhile are read, and the replies to
+        # them sent, in as few system calls as the platform allows
+        self.batch = DatagramBatch(buffer_size=MAX_HEADER_SIZE + max_segment_size, native=batch_io)
+        self.outbox = []
+        # connection table: one state machine per client, keyed by client address
+        self.connections = {}
+        # where received data goes; a sink is opened for every connection;
+        # {host} and {port} in output_file are replaced with the client's address
+        self.output_file = output_file
+        self.segment_files = segment_files # also write each segment to its own file (debugging)
+        self.fsync = fsync
+        self.preallocate = preallocate
+        self.sink_factory = sink_factory or self.open_file_sink
+        self.trace = trace # PacketTrace recording every segment sent and received, or None
+        self.metrics = metrics # MetricsRegistry with per connection counters, or None
+        if metrics is not None:
+            metrics.gauge('server_connections', 'connections open, including those in TIME_WAIT',
+                fn=lambda: len(self.connections))
 
     def setup_logging(self, verbose):
         """ set up self.logger for producer logging """
@@ -19,8 +62,12 @@ class Server:
         handler = logging.StreamHandler()
         handler.setFormatter(formatter)
         self.prefix = {'prefix': 'Server'}
-        self.logger.addHandler(handler)
+        if not self.logger.handlers:
+            # several instances in one process (e.g. bench.py) share the logger
+            self.logger.addHandler(handler)
         self.logger = logging.LoggerAdapter(self.logger, self.prefix)
+        # per segment debug messages are not even formatted unless verbose
+        self.verbose = verbose
         if verbose:
             self.logger.setLevel(logging.DEBUG)
             self.logger.debug('Debug mode enabled', extra=self.prefix)
@@ -37,145 +84,134 @@ class Server:
         self.logger.error(msg, extra=self.prefix)
 
     def start(self, udp_ip, udp_port):
+        """ Bind and serve until stop() is called """
+        self.bind(udp_ip, udp_port)
+        self.serve()
+
+    def bind(self, udp_ip, udp_port):
+        """ Open the server socket; with udp_port 0 the OS picks a free
+        port, which is then found in self.udp_port """
         self.debug(f'Starting server on {udp_ip}:{udp_port}')
         self.sock = socket.socket(socket.AF_INET,    # Internet
                                   socket.SOCK_DGRAM)  # UDP
         self.debug(f'Binding to ({udp_ip}, {udp_port})')
         # self.sock.bind((udp_ip, udp_port))
         self.sock.bind(('', udp_port))
-        # the server runs in an infinite loop and takes
-        # action based on current state and updates its state
-        # accordingly
-        # You will need to add more states, please update the possible
-        # states in py file
-        self.debug("Beginning infinite loop to listen for client connections")
-        while True:
-            if self.server_state == States.CLOSED:
-                # we already started listening, just update the state
-                self.update_server_state(States.LISTEN)
-            elif self.server_state == States.LISTEN:
-                # we are waiting for a message
-                self.debug("Waiting for message...")
-                header, body, addr = self.recv_msg()
-                self.debug("\nRECEIVED")
-                self.debug(f'{header} {body} {addr}')
-                if header.syn == 1:
-                    self.debug('SYN received, new handshake started by client')
-                    self.update_server_state(States.SYN_RECEIVED)
-                    self.seq_num = rand_int()
-                    self.ack_num = header.seq_num + 1
-                    # Update max segment size to reflect client value
-                    self.max_segment_size = header.mss
-                    syn_ack_header = Header(
-                        seq_num=self.seq_num,
-                        ack_num=self.ack_num,
-                        syn=1,
-                        ack=1
-                    )
-                    self.debug("\nSENDING")
-                    self.debug(syn_ack_header)
-                    self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
-                    self.sock.sendto(syn_ack_header.bits(), addr)
-                    self.update_server_state(States.SYNACK_SENT)
-                    self.last_received_seq_num = header.seq_num
-
-            elif self.server_state == States.SYNACK_SENT:
-                header, body, addr = self.recv_msg()
-                self.debug("\nRECEIVED ")
-                self.debug(f'{header} {body} {addr}')
-                self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
-                if header.ack == 1:
-                    self.update_server_state(States.ACK_RECEIVED)
-                    self.update_server_state(States.ESTABLISHED)
-
-            elif self.server_state == States.ESTABLISHED:
-                # Listen for normal messages AND for FIN messages
-                header, body, addr = self.recv_msg()
-                self.debug("\nRECEIVED")
-                self.debug(f'{header} {body} {addr}')
-                self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
-                if header.fin == 1:
-                    self.update_server_state(States.FIN_RECEIVED)
-                    self.seq_num = header.ack_num
-                    self.ack_num = header.seq_num + 1
-                    fin_ack_header = Header(
-                        seq_num=self.seq_num,
-                        ack_num=self.ack_num,
-                        ack=1,
-                        fin=1
-                    )
-                    self.debug("\nSENDING")
-                    self.debug(fin_ack_header)
-                    self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
-                    self.sock.sendto(fin_ack_header.bits(), addr)
-                    self.update_server_state(States.FINACK_SENT)
-
-                elif header.psh == 1:
-                    self.debug(f'Payload Length: {len(str.encode(body))}')
-                    if header.seq_num == self.last_received_seq_num:
-                        self.debug(f'Duplicate! seq_num {header.seq_num} matches previous seq num')
-                    else:
-                        self.message_buffer.append(body)
-                        self.debug(f'Received message buffer: {self.message_buffer}')
-                        with open('./server/received-full-msg.txt','w') as f:
-                            f.writelines(self.message_buffer)
-                    self.seq_num = header.ack_num
-                    self.ack_num += len(str.encode(body))
-                    with open(f'./server/received-seqnum-{header.seq_num}.txt','w') as f:
-                        f.write(body)
-                    # Keep sequence number at current value
-                    # respond with ACK
-                    ack_header = Header(
-                        seq_num=self.seq_num,
-                        ack_num=self.ack_num,
-                        ack=1
-                    )
-                    self.debug("\nSENDING")
-                    self.debug(ack_header)
-                    self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
-                    self.sock.sendto(ack_header.bits(), addr)
-                self.last_received_seq_num = header.seq_num
-
-            elif self.server_state == States.FINACK_SENT:
-                header, body, addr = self.recv_msg()
-                self.seq_num = header.ack_num
-                self.ack_num = header.seq_num + 1
-                self.debug("\nRECEIVED")
-                self.debug(f'{header} {body} {addr}')
-                self.debug(f'Current seq_num={self.seq_num}, ack_num={self.ack_num}')
-                if header.ack == 1:
-                    self.update_server_state(States.ACK_RECEIVED)
-                    self.debug('Completed 3-way termination')
-                    self.update_server_state(States.TIME_WAIT)
-                    self.time_wait()
-                self.last_received_seq_num = header.seq_num
-
-    def time_wait(self):
-        """ Currently in TIME WAIT state ; wait 2 * Max Segment Lifetime then close socket,
-        Assume Max Segment Lifetime is 5 seconds """
-        max_segment_lifetime = 5
-        wait_time = 2 * max_segment_lifetime
-        while wait_time > 0 :
-            self.debug(f'TIME_WAIT(remaining={wait_time}s)')
-            time.sleep(1)
-            wait_time -= 1
-        self.debug('TIME WAIT over, can listen again')
+        self.udp_port = self.sock.getsockname()[1]
+        # we already started listening, just update the state
         self.update_server_state(States.LISTEN)
 
+    def serve(self):
+        """ The server runs in a loop, handing every datagram to the
+        connection of the client that sent it; each connection takes action
+        based on its own state and updates it accordingly """
+        self.debug("Beginning loop to listen for client connections")
+        try:
+            while not self.event_terminate.is_set():
+                # block until a datagram arrives or the next timer is due, and
+                # wake up regularly enough to notice event_terminate
+                self.sock.settimeout(self.timers.timeout(maximum=1.0))
+                try:
+                    nbytes, addr = self.sock.recvfrom_into(self.recv_buffer)
+                except (socket.timeout, BlockingIOError):
+                    pass
+                else:
+                    self.datagram_received(memoryview(self.recv_buffer)[:nbytes], addr)
+                    for data, addr in self.batch.recv(self.sock):
+                        self.datagram_received(data, addr)
+                self.timers.run_due()
+                self.flush()
+        finally:
+            for addr in list(self.connections):
+                self.remove_connection(addr)
+            self.sock.close()
+
+    def stop(self):
+        self.event_terminate.set()
+
+    def handle(self, header, body, addr):
+        """ Dispatch a datagram to the connection of the client that sent it,
+        opening a new connection for a SYN from an unknown client """
+        connection = self.connections.get(addr)
+        if connection is not None and header.syn == 1 and connection.state == States.TIME_WAIT:
+            # the client reused its port for a new connection
+            self.remove_connection(addr)
+            connection = None
+        if connection is None:
+            if header.syn != 1:
+                self.debug(f'Ignoring segment from {addr}, no connection open')
+                return
+            connection = ServerConnection(
+                addr,
+                lambda data: self.sendto(data, addr),
+                self.sink_factory,
+                window_size=self.window_size,
+                max_segment_size=self.max_segment_size,
+                ack_every=self.ack_every,
+                ack_delay=self.ack_delay,
+                call_later=self.call_later,
+                time_wait=self.time_wait_on_terminate,
+                on_closed=self.connection_closed,
+                trace=self.trace,
+                metrics=self.metrics,
+                log=self
+            )
+            self.connections[addr] = connection
+            self.debug(f'New connection from {addr}; {len(self.connections)} connections open')
+        connection.handle(header, body)
+
+    def datagram_received(self, data, addr):
+        try:
+            header = bits_to_header(data)
+        except ValueError as e:
+            # a stray or corrupt datagram must not take down every connection
+            self.error(f'Dropping malformed datagram of {len(data)} bytes from {addr}: {e}')
+            return
+        if self.trace is not None:
+            self.trace.record(RECV, header, len(data), addr[1])
+        self.handle(header, get_body_from_data(data), addr)
+
+    def call_later(self, delay, callback, *args):
+        return self.timers.call_later(delay, callback, *args)
+
+    def sendto(self, data, addr):
+        # sent by flush() once the datagrams at hand have been handled
+        self.outbox.append(((data,), addr))
+
+    def flush(self):
+        if self.outbox:
+            self.batch.send(self.sock, self.outbox)
+            self.outbox.clear()
+
+    def connection_closed(self, connection):
+        """ Forget a connection whose TIME_WAIT is over """
+        if self.connections.get(connection.addr) is connection:
+            self.remove_connection(connection.addr)
+            self.debug(f'{len(self.connections)} connections open')
+
+    def remove_connection(self, addr):
+        connection = self.connections.pop(addr)
+        connection.close()
+
+    def open_file_sink(self, addr):
+        """ Default sink: stream the client's message to self.output_file """
+        host, port = addr[0], addr[1]
+        sink = FileSink(
+            self.output_file.format(host=host, port=port),
+            fsync=self.fsync,
+            preallocate=self.preallocate
+        )
+        if self.segment_files:
+            return TeeSink(sink, SegmentFileSink(
+                os.path.dirname(self.output_file) or '.',
+                prefix=f'received-{host}_{port}-seqnum-'))
+        return sink
+
     def update_server_state(self, new_state):
         """ Update the self.server_state attribute with new state"""
         self.debug(f'{self.server_state} -> {new_state}')
         self.server_state = new_state
 
-    def recv_msg(self):
-        """ Receive a message and return header, body and addr; addr
-        is used to reply to the client; this call is blocking """
-        data, addr = self.sock.recvfrom(1024)
-        header = bits_to_header(data)
-        body = get_body_from_data(data)
-        return (header, body, addr)
-
-
 if __name__ == "__main__":
     server = Server()
     UDP_PORT_SERVER = 5008
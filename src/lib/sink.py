@@ -0,0 +1,95 @@
+""" Sinks the server delivers in-order data to. A sink only needs
+write(seq_num, data) and close(); data may be a memoryview of the receive
+buffer, only valid during the call """
+import os
+
+
+class FileSink:
+    """ Append-only writer for the received message. Writes are batched in
+    memory and flushed once buffer_size bytes are pending, so each segment
+    costs no disk I/O of its own """
+    def __init__(self, path, buffer_size=64 * 1024, fsync=False, preallocate=0):
+        """ fsync: also fsync on every flush (durable, slower);
+        preallocate: reserve this many bytes up front so the file system can
+        allocate contiguous blocks; the file is truncated to size on close """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.buffer = bytearray()
+        self.bytes_written = 0
+        self.file = open(path, 'wb')
+        self.preallocated = 0
+        if preallocate and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.file.fileno(), 0, preallocate)
+                self.preallocated = preallocate
+            except OSError:
+                pass # not supported by the file system; just grow as we go
+
+    def write(self, seq_num, data):
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.bytes_written += len(self.buffer)
+            self.buffer.clear()
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        if self.preallocated > self.bytes_written:
+            self.file.truncate(self.bytes_written)
+        self.file.close()
+
+
+class SegmentFileSink:
+    """ Debugging aid: writes every delivered segment to its own
+    <prefix><seq_num>.txt file """
+    def __init__(self, directory, prefix='received-seqnum-'):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+
+    def write(self, seq_num, data):
+        with open(os.path.join(self.directory, f'{self.prefix}{seq_num}.txt'), 'wb') as f:
+            f.write(data)
+
+    def close(self):
+        pass
+
+
+class TeeSink:
+    """ Deliver the same data to several sinks """
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def write(self, seq_num, data):
+        for sink in self.sinks:
+            sink.write(seq_num, data)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class MemorySink:
+    """ Keep the received message in memory, e.g. to check it in benchmarks """
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, seq_num, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,60 @@
+""" Import time profile of the driver (--startup_profile): times every
+module imported while it starts, like python -X importtime, and reports the
+slowest ones once the selected role is ready to run """
+import builtins
+import importlib.util
+import sys
+import time
+
+
+class ImportProfiler:
+    """ Replaces builtins.__import__ between start() and stop() to time the
+    first import of each module. A module's cumulative time includes the
+    modules it imports; its self time does not """
+    def __init__(self):
+        self.times = {} # module name -> (cumulative, self) seconds, in import order
+        self.stack = [] # time spent in nested imports of each import in progress
+        self.original_import = None
+
+    def start(self):
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.timed_import
+        self.started = time.perf_counter()
+        return self
+
+    def stop(self):
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+            self.elapsed = time.perf_counter() - self.started
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level:
+            package = (globals or {}).get('__package__')
+            module = importlib.util.resolve_name('.' * level + name, package) if package else name
+        else:
+            module = name
+        if not module or module in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+        self.stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = time.perf_counter() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += cumulative
+            self.times.setdefault(module, (cumulative, cumulative - nested))
+
+    def report(self, limit=25):
+        """ The slowest imports by cumulative time, in milliseconds """
+        lines = [f'{"cumulative":>10} {"self":>8}  module']
+        slowest = sorted(self.times.items(), key=lambda item: item[1][0], reverse=True)
+        for module, (cumulative, own) in slowest[:limit]:
+            lines.append(f'{cumulative * 1000:>10.1f} {own * 1000:>8.1f}  {module}')
+        total = sum(own for cumulative, own in self.times.values())
+        lines.append(
+            f'{len(self.times)} modules imported in {total * 1000:.1f} ms; '
+            f'{self.elapsed * 1000:.1f} ms from the start of the driver to the role being ready')
+        return '\n'.join(lines)
@@ -0,0 +1,206 @@
+""" Background export of the client's per-chunk records to CouchDB
+(--dump_couchdb). Records are posted in _bulk_docs batches while the
+transfer runs; those the database cannot take are kept in a JSON-lines spool
+file, one record per line, and saved from it by the next run that reaches
+the database """
+import base64
+import http.client
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+
+class TelemetryExporter:
+    """ Exports the client's per-chunk records to CouchDB while the transfer
+    runs: a daemon thread collects submitted records into _bulk_docs posts
+    of up to batch_size documents, sent over one keep-alive connection.
+    Records that cannot be posted (database down, network error) are
+    appended to a local JSON-lines spool file, which is replayed ahead of
+    new records once the database answers again. Every record gets its _id
+    when submitted, so a post that is retried after an unclear failure is
+    stored only once (the second copy is a conflict, counted as saved) """
+    def __init__(self, server='localhost:5984', user='admin', password='123456',
+            database='database', spool_path='couchdb-spool.jsonl', batch_size=500,
+            flush_interval=1.0, retry_interval=5.0, timeout=10, verbose=False):
+        self.setup_logging(verbose=verbose)
+        self.server = server # host:port
+        self.database = database
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval # max seconds a record waits to be posted
+        self.retry_interval = retry_interval # seconds between attempts while the database is down
+        self.timeout = timeout
+        credentials = base64.b64encode(f'{user}:{password}'.encode()).decode()
+        self.headers = {
+            'Authorization': f'Basic {credentials}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+        }
+        self.records = queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.conn = None
+        self.database_created = False
+        self.retry_at = 0 # no posts before this time, after a failure
+        self.saved = 0
+        self.spooled = 0
+        self.failed = 0
+
+    @classmethod
+    def from_environment(cls, **kwargs):
+        """ An exporter to the database given by the COUCHDB_* environment
+        variables """
+        return cls(
+            server=os.environ.get('COUCHDB_SERVER', 'localhost:5984'),
+            user=os.environ.get('COUCHDB_USER', 'admin'),
+            password=os.environ.get('COUCHDB_PASSWORD', '123456'),
+            database=os.environ.get('COUCHDB_DATABASE', 'database'),
+            **kwargs)
+
+    def setup_logging(self, verbose):
+        """ set up self.logger for telemetry logging """
+        self.logger = logging.getLogger('TelemetryExporter')
+        formatter = logging.Formatter('%(prefix)s - %(message)s')
+        handler = logging.StreamHandler()
+        handler.setFormatter(formatter)
+        self.prefix = {'prefix': 'Telemetry'}
+        if not self.logger.handlers:
+            self.logger.addHandler(handler)
+        self.logger = logging.LoggerAdapter(self.logger, self.prefix)
+        if verbose:
+            self.logger.setLevel(logging.DEBUG)
+            self.logger.debug('Debug mode enabled', extra=self.prefix)
+        else:
+            self.logger.setLevel(logging.INFO)
+
+    def debug(self, msg):
+        self.logger.debug(msg, extra=self.prefix)
+
+    def info(self, msg):
+        self.logger.info(msg, extra=self.prefix)
+
+    def error(self, msg):
+        self.logger.error(msg, extra=self.prefix)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def submit(self, record):
+        """ Queue a record (a dict) for export; never blocks """
+        record.setdefault('_id', uuid.uuid4().hex)
+        self.records.put(record)
+
+    def stop(self):
+        """ Post (or spool) everything submitted so far and stop the thread """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.conn is not None:
+            self.conn.close()
+        self.info(
+            f'Saved {self.saved} records to {self.database}'
+            + (f', spooled {self.spooled} to {self.spool_path}' if self.spooled else '')
+            + (f', {self.failed} rejected' if self.failed else ''))
+
+    def run(self):
+        if os.path.exists(self.spool_path):
+            self.replay()
+        while True:
+            stopping = self.stopped.is_set()
+            batch = self.next_batch()
+            if batch:
+                self.flush(batch)
+            elif stopping:
+                return
+
+    def next_batch(self):
+        """ Up to batch_size records, waiting at most flush_interval for the
+        first; whatever is queued once stopped """
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                if self.stopped.is_set():
+                    batch.append(self.records.get_nowait())
+                else:
+                    batch.append(self.records.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self, batch):
+        """ Post a batch, after any spooled records; spool it if the
+        database cannot be reached """
+        if time.monotonic() >= self.retry_at:
+            if os.path.exists(self.spool_path):
+                self.replay()
+            if not os.path.exists(self.spool_path) and self.post(batch):
+                return
+        self.spool(batch)
+
+    def spool(self, batch):
+        with open(self.spool_path, 'a') as f:
+            for record in batch:
+                f.write(json.dumps(record) + '\n')
+        self.spooled += len(batch)
+        self.debug(f'Spooled {len(batch)} records to {self.spool_path}')
+
+    def replay(self):
+        """ Post the spooled records; the spool file is removed once they
+        are all saved """
+        with open(self.spool_path) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        for start in range(0, len(records), self.batch_size):
+            if not self.post(records[start:start + self.batch_size]):
+                return
+        os.remove(self.spool_path)
+        self.info(f'Replayed {len(records)} spooled records from {self.spool_path}')
+
+    def post(self, docs):
+        """ Save docs with one _bulk_docs request; False if the database
+        could not be reached, in which case posts pause for retry_interval """
+        try:
+            if not self.database_created:
+                # 412: it already exists
+                status, results = self.request('PUT', f'/{self.database}')
+                if status >= 300 and status != 412:
+                    raise http.client.HTTPException(f'{status} {results}')
+                self.database_created = True
+            status, results = self.request('POST', f'/{self.database}/_bulk_docs', {'docs': docs})
+            if status >= 300:
+                raise http.client.HTTPException(f'{status} {results}')
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            self.error(f'Could not post {len(docs)} records to {self.server}: {e}')
+            self.retry_at = time.monotonic() + self.retry_interval
+            return False
+        for result in results:
+            # a conflict is a record saved by an earlier attempt
+            if 'error' in result and result['error'] != 'conflict':
+                self.error(f'Failed to save {result.get("id")}: {result.get("reason")}')
+                self.failed += 1
+            else:
+                self.saved += 1
+        return True
+
+    def request(self, method, path, body=None):
+        """ Send a request on the keep-alive connection, opened again if the
+        server closed it; return the status and the decoded response """
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.server, timeout=self.timeout)
+        try:
+            self.conn.request(
+                method, path, body=None if body is None else json.dumps(body),
+                headers=self.headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except:
+            self.conn.close()
+            self.conn = None
+            raise
+        return response.status, json.loads(data) if data else None
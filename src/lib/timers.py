@@ -0,0 +1,68 @@
+""" Timer heap for the blocking event loops (Channel, Server). It mirrors the
+call_later / cancel interface of an asyncio event loop, so code that schedules
+timers works the same on either """
+import heapq
+import itertools
+import time
+
+
+class Timer:
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerQueue:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.heap = [] # (when, tie breaker, Timer)
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def time(self):
+        return self.clock()
+
+    def call_at(self, when, callback, *args):
+        """ Run callback(*args) once the clock reaches when """
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.heap, (when, next(self.counter), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """ Run callback(*args) after delay seconds """
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def next_deadline(self):
+        """ When the earliest pending timer fires, or None """
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def timeout(self, maximum=None):
+        """ Seconds until the earliest pending timer fires (at most maximum),
+        suitable for select(); None if nothing is pending and no maximum """
+        deadline = self.next_deadline()
+        if deadline is None:
+            return maximum
+        timeout = max(deadline - self.clock(), 0)
+        return timeout if maximum is None else min(timeout, maximum)
+
+    def run_due(self):
+        """ Run every timer that is due; return how many ran """
+        ran = 0
+        now = self.clock()
+        while self.heap and self.heap[0][0] <= now:
+            timer = heapq.heappop(self.heap)[2]
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+                ran += 1
+        return ran
@@ -0,0 +1,102 @@
+""" Packet trace: a compact binary record of every segment a component sends,
+receives or drops, kept in a preallocated ring buffer so tracing costs one
+struct pack per packet. Nothing is formatted while the protocol runs; the
+trace is dumped to a file when the component exits and decoded afterwards:
+
+    python -m lib.trace client.trace server.trace channel.trace
+
+prints the events of all the files merged in time order """
+import argparse
+import collections
+import heapq
+import os
+import struct
+import time
+
+# event kinds
+SEND, RECV, DROP, RESEND = 1, 2, 3, 4
+EVENTS = {SEND: 'SEND', RECV: 'RECV', DROP: 'DROP', RESEND: 'RESEND'}
+
+# timestamp, event, flags (syn ack fin psh), seq_num, ack_num, datagram
+# length, peer port; little endian, 24 bytes per event
+RECORD = struct.Struct('<dBBIIIH')
+# magic, capacity, number of events recorded (may exceed the capacity)
+FILE_MAGIC = b'TCPUTRC1'
+FILE_HEADER = struct.Struct('<8sIQ')
+
+TraceRecord = collections.namedtuple(
+    'TraceRecord', 'time event syn ack fin psh seq_num ack_num length port')
+
+
+class PacketTrace:
+    """ The last `capacity` packet events, oldest overwritten first """
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self.buffer = bytearray(RECORD.size * capacity)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def record(self, event, header, length=0, port=0):
+        """ Record an event for a segment with the given Header; length is
+        the size of the datagram, port the port of the peer """
+        RECORD.pack_into(
+            self.buffer, (self.count % self.capacity) * RECORD.size,
+            time.time(), event,
+            header.syn << 3 | header.ack << 2 | header.fin << 1 | header.psh,
+            header.seq_num & 0xFFFFFFFF, header.ack_num & 0xFFFFFFFF,
+            length, port & 0xFFFF)
+        self.count += 1
+
+    def dump(self, path):
+        """ Write the recorded events, oldest first, to path """
+        start = self.count % self.capacity if self.count > self.capacity else 0
+        end = len(self) * RECORD.size
+        with open(path, 'wb') as f:
+            f.write(FILE_HEADER.pack(FILE_MAGIC, self.capacity, self.count))
+            f.write(self.buffer[start * RECORD.size:end])
+            f.write(self.buffer[:start * RECORD.size])
+
+
+def read_trace(path):
+    """ Yield the TraceRecords of a dumped trace, oldest first """
+    with open(path, 'rb') as f:
+        magic, capacity, count = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != FILE_MAGIC:
+            raise ValueError(f'{path} is not a packet trace')
+        data = f.read()
+    for t, event, flags, seq_num, ack_num, length, port in RECORD.iter_unpack(data):
+        yield TraceRecord(
+            t, event, flags >> 3 & 1, flags >> 2 & 1, flags >> 1 & 1, flags & 1,
+            seq_num, ack_num, length, port)
+
+
+def format_record(record, label='', start=None):
+    """ One line describing a TraceRecord; times are relative to start if given """
+    t = record.time - start if start is not None else record.time
+    flags = ''.join(name if set_ else '.' for name, set_ in (
+        ('S', record.syn), ('A', record.ack), ('F', record.fin), ('P', record.psh)))
+    return (f'{t:.6f} {label:<10} {EVENTS.get(record.event, record.event):<6} {flags} '
+        f'seq={record.seq_num} ack={record.ack_num} len={record.length} port={record.port}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('decode packet traces dumped with --trace')
+    parser.add_argument('traces', nargs='+', help=(
+        'trace files; events of several files (e.g. client, channel and server) '
+        'are merged in time order and labelled with the file name'
+    ))
+    parser.add_argument('-abs', '--absolute_time', action='store_true', help=(
+        'print wall clock timestamps instead of seconds since the first event'
+    ))
+    args = parser.parse_args()
+
+    labels = [os.path.splitext(os.path.basename(path))[0] for path in args.traces]
+    records = [
+        [(record, label) for record in read_trace(path)]
+        for path, label in zip(args.traces, labels)]
+    merged = list(heapq.merge(*records, key=lambda item: item[0].time))
+    start = None if args.absolute_time or not merged else merged[0][0].time
+    for record, label in merged:
+        print(format_record(record, label, start))
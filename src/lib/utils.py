@@ -2,7 +2,9 @@ from enum import Enum
 import random
 from datetime import datetime
 import os
-DEBUG = True
+import socket
+import struct
+import sys
 
 # Extend the possible states based on your implementation
 # Refer TCP protocol
@@ -13,32 +15,116 @@ class States(Enum):
 				ESTABLISHED, FIN_SENT, FIN_RECEIVED, FINACK_RECEIVED,\
 					FINACK_SENT, PSH_RECEIVED, PSH_SENT = range(1, 17)
 
+# Wire format of the 12 byte header (network byte order):
+#   seq_num (32) | ack_num (32) | syn ack fin psh mss (8) | version (8) |
+#   options length (8) | reserved (8)
+# followed by `options length` bytes of TCP style kind/length/value options.
+# The flag/mss byte keeps the bit order of the legacy ASCII header so the
+# two formats describe exactly the same fields.
+HEADER_VERSION = 1
+HEADER_SIZE = 12
+HEADER_STRUCT = struct.Struct('!IIBBBx')
+MAX_HEADER_SIZE = HEADER_SIZE + 255 # the options length is a single byte
+# Options
+OPTION_END, OPTION_NOP = 0, 1
+OPTION_MSS = 2 # max segment size, 16 bits, only sent on SYN segments
+MSS_STRUCT = struct.Struct('!H')
+OPTION_SACK = 5 # selective acknowledgement: (left, right) seq num pairs, right exclusive
+SACK_BLOCK_STRUCT = struct.Struct('!II')
+MAX_SACK_BLOCKS = 4
+# the 4 bit mss field of the flag byte can only hold up to 15; larger
+# values need the MSS option
+MAX_MSS_FIELD = 0xF
+MAX_MSS = 0xFFFF
+UDP_IP_OVERHEAD = 20 + 8 # IPv4 and UDP headers
+# Legacy format: the same 96 bits written out as '0'/'1' characters
+LEGACY_HEADER_SIZE = 96
+LEGACY_DIGITS = (ord('0'), ord('1'))
+# Format used when encoding; decoding always detects the format of the datagram
+HEADER_FORMATS = ('binary', 'legacy')
+HEADER_FORMAT = 'binary'
+
+# Channel parameters saved with each measurement of the client, which the
+# aggregator and the results store group measurements by, in key order
+GROUP_FIELDS = ('channel_p_drop_server', 'channel_p_drop_client', 'channel_sleep_v', 'channel_sleep_factor')
+
+# Choices of the driver's arguments, kept here so that parsing them does not
+# import the client or the aggregator.
+# Sliding window protocols of the client (see window.py)
+# Go-Back-N: a timeout resends every outstanding segment
+# Selective Repeat: segments the receiver reports holding (SACK) are not resent,
+# a timeout resends only the holes
+TRANSFER_MODES = ('gbn', 'sr')
+# keys of congestion.CONGESTION_CONTROLS
+CONGESTION_CONTROL_NAMES = ('none', 'reno', 'cubic')
+# ways Aggregator.aggregate() can group the analytics documents: in process
+# with NumPy, with Spark (pyspark is optional, for datasets that outgrow one
+# machine), or with a map/reduce view inside CouchDB
+ENGINES = ('numpy', 'spark', 'view')
+
+def set_header_format(header_format):
+	""" Choose the wire format used by Header.bits(); 'legacy' restores the
+	ASCII bit string header for interoperability with older peers """
+	global HEADER_FORMAT
+	if header_format not in HEADER_FORMATS:
+		raise ValueError(f'Unknown header format {header_format}; expected one of {HEADER_FORMATS}')
+	HEADER_FORMAT = header_format
+
 class Header:
-	def __init__(self, seq_num=0, ack_num=0, syn=0, ack=0, fin=0, psh=0, mss=12):
+	def __init__(self, seq_num=0, ack_num=0, syn=0, ack=0, fin=0, psh=0, mss=12, sack_blocks=None):
 		self.seq_num = seq_num
 		self.ack_num = ack_num
 		self.syn = syn
 		self.ack = ack
 		self.fin = fin
 		self.psh = psh
-		self.mss = mss # MSS option - max segment size, 4 bits
+		# max segment size; the 4 bit field carries min(mss, 15), SYN segments
+		# also carry the full value as an MSS option (binary format only)
+		self.mss = mss
+		# SACK option - (left, right) seq num ranges received beyond ack_num;
+		# binary format only, the legacy header has no room for options
+		self.sack_blocks = sack_blocks or []
 
 	def __str__(self):
-		return pretty_bits_print(self.bits().decode())
+		if self.sack_blocks:
+			return pretty_bits_print(self.legacy_bits()) + f'\n : sack = {self.sack_blocks}'
+		return pretty_bits_print(self.legacy_bits())
 
 	def bits(self):
-		""" Get the bits representation of the header """
+		""" Get the wire representation of the header (packed binary unless
+		the legacy format has been selected with set_header_format) """
+		if HEADER_FORMAT == 'legacy':
+			return self.legacy_bits().encode()
+		options = self.options()
+		return HEADER_STRUCT.pack(
+			self.seq_num,
+			self.ack_num,
+			self.syn << 7 | self.ack << 6 | self.fin << 5 | self.psh << 4 | min(self.mss, MAX_MSS_FIELD),
+			HEADER_VERSION,
+			len(options)) + options
+
+	def options(self):
+		""" Get the encoded options area of the header """
+		options = b''
+		if self.syn:
+			options += bytes((OPTION_MSS, 2 + MSS_STRUCT.size)) + MSS_STRUCT.pack(min(self.mss, MAX_MSS))
+		if self.sack_blocks:
+			blocks = self.sack_blocks[:MAX_SACK_BLOCKS]
+			options += bytes((OPTION_SACK, 2 + SACK_BLOCK_STRUCT.size * len(blocks))) + \
+				b''.join(SACK_BLOCK_STRUCT.pack(left, right) for left, right in blocks)
+		return options
+
+	def legacy_bits(self):
+		""" Get the legacy ASCII bits representation of the header """
 		bits = '{0:032b}'.format(self.seq_num)
 		bits += '{0:032b}'.format(self.ack_num)
 		bits += '{0:01b}'.format(self.syn)
 		bits += '{0:01b}'.format(self.ack)
 		bits += '{0:01b}'.format(self.fin)
 		bits += '{0:01b}'.format(self.psh)
-		bits += '{0:04b}'.format(self.mss)
+		bits += '{0:04b}'.format(min(self.mss, MAX_MSS_FIELD))
 		bits += '{0:024b}'.format(0)
-		if (DEBUG):
-			print(pretty_bits_print(bits))
-		return bits.encode()
+		return bits
 
 def create_timestamped_folder():
 	mydir = os.path.join(
@@ -49,9 +135,84 @@ def create_timestamped_folder():
 	except:
 		pass
 
+def is_legacy_header(data):
+	""" Legacy headers are ASCII digits; byte 9 of a binary header holds the
+	version, which can never be '0' or '1' """
+	return len(data) >= LEGACY_HEADER_SIZE and data[9] in LEGACY_DIGITS
+
+
 def bits_to_header(bits):
-	""" Convert bits to an instance of Header """
-	bits = bits.decode()
+	""" Convert a datagram (binary or legacy header) to an instance of Header;
+	ValueError if it does not start with a well formed header """
+	if is_legacy_header(bits):
+		return legacy_bits_to_header(bits)
+	if len(bits) < HEADER_SIZE:
+		raise ValueError(f'Datagram of {len(bits)} bytes is shorter than a header')
+	seq_num, ack_num, flags, version, options_length = HEADER_STRUCT.unpack_from(bits)
+	if version != HEADER_VERSION:
+		raise ValueError(f'Unsupported header version {version}')
+	if HEADER_SIZE + options_length > len(bits):
+		raise ValueError(f'Header options of {options_length} bytes run past the end of the datagram')
+	header = Header(
+		seq_num, ack_num,
+		flags >> 7, flags >> 6 & 1, flags >> 5 & 1, flags >> 4 & 1,
+		flags & 0xF)
+	if options_length:
+		parse_options(header, bits[HEADER_SIZE:HEADER_SIZE + options_length])
+	return header
+
+
+def parse_options(header, options):
+	""" Set the fields of header carried in an encoded options area; unknown
+	options are skipped. A malformed option raises ValueError """
+	i = 0
+	while i < len(options):
+		kind = options[i]
+		if kind == OPTION_END:
+			break
+		if kind == OPTION_NOP:
+			i += 1
+			continue
+		if i + 1 == len(options):
+			raise ValueError(f'Header option {kind} has no length')
+		length = options[i + 1]
+		if length < 2 or i + length > len(options):
+			raise ValueError(f'Malformed header option {kind} of length {length}')
+		if kind == OPTION_MSS and length != 2 + MSS_STRUCT.size or \
+				kind == OPTION_SACK and (length - 2) % SACK_BLOCK_STRUCT.size:
+			raise ValueError(f'Malformed header option {kind} of length {length}')
+		if kind == OPTION_MSS:
+			header.mss, = MSS_STRUCT.unpack_from(options, i + 2)
+		elif kind == OPTION_SACK:
+			header.sack_blocks = [
+				SACK_BLOCK_STRUCT.unpack_from(options, offset)
+				for offset in range(i + 2, i + length, SACK_BLOCK_STRUCT.size)]
+		i += length
+
+
+def probe_path_mss(addr):
+	""" Largest segment payload that reaches addr without IP fragmentation,
+	from the path MTU the kernel knows for it (Linux only, e.g. 65536 on
+	loopback); None where this cannot be asked """
+	if not sys.platform.startswith('linux'):
+		return None
+	IP_MTU_DISCOVER, IP_PMTUDISC_DO, IP_MTU = 10, 2, 14 # <linux/in.h>
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	try:
+		sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+		sock.connect(addr)
+		mtu = sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+	except OSError:
+		return None
+	finally:
+		sock.close()
+	# the largest UDP payload is 65507 bytes, whatever the MTU
+	return min(mtu, 0xFFFF) - UDP_IP_OVERHEAD - HEADER_SIZE
+
+
+def legacy_bits_to_header(bits):
+	""" Convert legacy ASCII bits to an instance of Header """
+	bits = bytes(bits[:LEGACY_HEADER_SIZE]).decode()
 	seq_num = int(bits[:32], 2)
 	ack_num = int(bits[32:64], 2)
 	syn = int(bits[64], 2)
@@ -64,11 +225,13 @@ def bits_to_header(bits):
 
 def get_body_from_data(data):
 	"""
-	Returns the bits beyond the first 12 bytes
-	If your header is 12 bytes (96 bits), it returns the body of a message
+	Returns the bytes beyond the header (12 bytes plus options, or 96 for a
+	legacy header) as a memoryview of data, without copying; copy it
+	(bytes(body)) to keep it beyond the life of a reused receive buffer
 	"""
-	data = data.decode()
-	return data[96:]
+	if is_legacy_header(data):
+		return memoryview(data)[LEGACY_HEADER_SIZE:]
+	return memoryview(data)[HEADER_SIZE + data[10]:]
 
 
 def pretty_bits_print(bits):
@@ -0,0 +1,196 @@
+""" Sender side of the sliding window protocol used by the client; the window
+does no I/O itself, it only decides what should be (re)sent and when, so any
+transport can drive it """
+from collections import OrderedDict
+from .utils import TRANSFER_MODES
+from .rto import RTOEstimator
+from .congestion import CongestionControl
+
+
+class Segment:
+    """ A chunk of the message that has been handed to the window """
+    def __init__(self, seq_num, payload):
+        self.seq_num = seq_num
+        self.payload = payload
+        self.end = seq_num + len(payload) # seq num that acknowledges this segment
+        self.first_sent = None
+        self.last_sent = None
+        self.deadline = None # when the retransmission timer for this segment fires
+        self.transmissions = 0
+        self.acked = False
+        self.retransmit = None # 'timeout' or 'fast' once lost, until cwnd lets it be resent
+
+
+class SlidingWindow:
+    def __init__(self, chunks, seq_num, window_size=1, mode='gbn', rto=None, congestion=None):
+        """ chunks is an iterable of payloads; it is only consumed as the window
+        opens, so it can be a generator over an arbitrarily large message.
+        A window_size of 1 is plain stop-and-wait. rto is the RTOEstimator
+        that times retransmissions and congestion the CongestionControl whose
+        cwnd further limits the bytes in flight; pass the connection's so
+        their state carries over between messages """
+        if mode not in TRANSFER_MODES:
+            raise ValueError(f'Unknown transfer mode {mode}; expected one of {TRANSFER_MODES}')
+        if window_size < 1:
+            raise ValueError('window_size must be at least 1')
+        self.chunks = iter(chunks)
+        self.exhausted = False
+        self.next_seq = seq_num # seq num of the next new segment
+        self.window_size = window_size
+        self.mode = mode
+        self.rto = rto if rto is not None else RTOEstimator()
+        self.congestion = congestion if congestion is not None else CongestionControl()
+        self.outstanding = OrderedDict() # seq_num -> Segment, oldest first
+        self.last_ack = seq_num
+        self.dup_acks = 0
+        self.rtt_sample = None # RTT measured by the last on_ack, if it gave a sample
+
+    @property
+    def base(self):
+        """ Lowest unacknowledged seq num """
+        for segment in self.outstanding.values():
+            return segment.seq_num
+        return self.next_seq
+
+    def done(self):
+        """ True once every chunk has been sent and acknowledged """
+        if not self.outstanding and not self.exhausted:
+            self._fill()
+        return self.exhausted and not self.outstanding
+
+    def _fill(self):
+        """ Pull chunks until the window is full; return the new segments """
+        new_segments = []
+        while not self.exhausted and len(self.outstanding) < self.window_size:
+            try:
+                payload = next(self.chunks)
+            except StopIteration:
+                self.exhausted = True
+                break
+            segment = Segment(self.next_seq, payload)
+            self.next_seq = segment.end
+            self.outstanding[segment.seq_num] = segment
+            new_segments.append(segment)
+        return new_segments
+
+    def bytes_in_flight(self):
+        return sum(len(s.payload) for s in self.outstanding.values()
+                   if s.transmissions and not s.acked and not s.retransmit)
+
+    def mark_sent(self, segment, now):
+        if segment.first_sent is None:
+            segment.first_sent = now
+        segment.last_sent = now
+        segment.deadline = now + self.rto.rto
+        segment.transmissions += 1
+        segment.retransmit = None
+
+    def segments_to_send(self, now):
+        """ Segments waiting to be resent and segments never sent, oldest
+        first, as many as the congestion window lets into flight """
+        self._fill()
+        flight = self.bytes_in_flight()
+        segments = []
+        for segment in self.outstanding.values():
+            if segment.acked or (segment.transmissions and not segment.retransmit):
+                continue
+            # one segment may always be sent, however small cwnd is, and a
+            # fast retransmit goes out right away
+            if flight and flight + len(segment.payload) > self.congestion.cwnd \
+                    and segment.retransmit != 'fast':
+                break
+            flight += len(segment.payload)
+            self.mark_sent(segment, now)
+            segments.append(segment)
+        return segments
+
+    def on_ack(self, ack_num, now, sack_blocks=()):
+        """ Process a cumulative ACK (and, with Selective Repeat, its SACK
+        blocks) and return the segments it newly acknowledged """
+        acked = []
+        flight = self.bytes_in_flight()
+        self.rtt_sample = None
+        # cumulative; everything below ack_num has been received
+        while self.outstanding:
+            segment = next(iter(self.outstanding.values()))
+            if segment.end > ack_num:
+                break
+            self.outstanding.popitem(last=False)
+            if not segment.acked:
+                segment.acked = True
+                acked.append(segment)
+        if self.mode == 'sr':
+            for left, right in sack_blocks:
+                for segment in self.outstanding.values():
+                    if segment.seq_num >= right:
+                        break
+                    if not segment.acked and segment.seq_num >= left and segment.end <= right:
+                        segment.acked = True
+                        acked.append(segment)
+        if acked:
+            self.rto.reset_backoff()
+            # Karn's rule: an ACK for a retransmitted segment is ambiguous,
+            # so only segments sent once give an RTT sample
+            # (a segment still queued to be resent was sent once, but the
+            # ACK that covers it was triggered by a later retransmission)
+            latest = acked[-1]
+            if latest.transmissions == 1 and not latest.retransmit:
+                self.rtt_sample = now - latest.first_sent
+                self.rto.sample(self.rtt_sample)
+        if ack_num > self.last_ack:
+            self.last_ack = ack_num
+            self.dup_acks = 0
+            self.congestion.on_ack(sum(len(s.payload) for s in acked), now, self.rto.srtt)
+        elif ack_num == self.last_ack and flight:
+            self.on_dup_ack(flight, now)
+        return acked
+
+    def on_dup_ack(self, flight, now):
+        """ The receiver got a segment beyond a gap; after DUPTHRESH of
+        these, resend the oldest segment without waiting for its timer """
+        self.dup_acks += 1
+        if not self.congestion.fast_retransmit:
+            return
+        if self.dup_acks == self.congestion.DUPTHRESH:
+            for segment in self.outstanding.values():
+                if not segment.acked and segment.transmissions and not segment.retransmit:
+                    segment.retransmit = 'fast'
+                    segment.deadline = None
+                    self.congestion.on_fast_retransmit(flight, now)
+                break
+        elif self.dup_acks > self.congestion.DUPTHRESH:
+            self.congestion.on_dup_ack()
+
+    def next_deadline(self):
+        """ Time at which the earliest retransmission timer fires, or None """
+        deadlines = [s.deadline for s in self.outstanding.values()
+                     if s.transmissions and not s.acked and not s.retransmit]
+        if not deadlines:
+            return None
+        if self.mode == 'gbn':
+            # a single timer, running for the oldest unacknowledged segment
+            return deadlines[0]
+        return min(deadlines)
+
+    def expired(self, now):
+        """ Segments whose timer has fired; the RTO is backed off, the
+        congestion window collapses and the segments are queued to be
+        resent by segments_to_send """
+        if self.mode == 'gbn':
+            deadline = self.next_deadline()
+            if deadline is None or now < deadline:
+                return []
+            segments = [s for s in self.outstanding.values()
+                        if s.transmissions and not s.retransmit]
+        else:
+            segments = [s for s in self.outstanding.values()
+                        if s.transmissions and not s.acked and not s.retransmit
+                        and now >= s.deadline]
+        if segments:
+            self.rto.backoff()
+            self.congestion.on_timeout(self.bytes_in_flight(), now)
+            self.dup_acks = 0
+        for segment in segments:
+            segment.retransmit = 'timeout'
+            segment.deadline = None
+        return segments